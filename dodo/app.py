@@ -23,7 +23,7 @@ from PyQt6.QtWebEngineCore import QWebEngineUrlScheme
 import sys
 import os
 import subprocess
-from typing import Optional, Literal
+from typing import Optional, Literal, Callable
 import logging
 
 from . import search
@@ -44,17 +44,50 @@ LOCAL_PROTOCOLS = ['cid', 'message']
 class SyncMailThread(QThread):
     """A QThread used for syncing local Maildir and notmuch with IMAP
 
-    Called by the :func:`~dodo.app.Dodo.sync_mail` method."""
+    Called by the :func:`~dodo.app.Dodo.sync_mail` method. If `fetch` is False, it only
+    runs `notmuch new`, which is used to index mail that was delivered by another program."""
 
-    def __init__(self, parent: QObject=None) -> None:
+    def __init__(self, parent: QObject=None, fetch: bool=True) -> None:
         super().__init__(parent)
+        self.fetch = fetch
 
     def run(self) -> None:
         """Run :func:`~dodo.settings.sync_mail_command` then `notmuch new`"""
-        subprocess.run(settings.sync_mail_command, stdout=subprocess.PIPE, shell=True)
+        if self.fetch:
+            subprocess.run(settings.sync_mail_command, stdout=subprocess.PIPE, shell=True)
         subprocess.run(['notmuch', 'new'], stdout=subprocess.PIPE)
 
 
+class TagThread(QThread):
+    """A QThread used for applying tags with "notmuch tag --batch"
+
+    Called by :func:`~dodo.app.Dodo.tag`, which collects tag operations into batches."""
+
+    def __init__(self, batch: list[str], parent: QObject=None) -> None:
+        super().__init__(parent)
+        self.batch = batch
+
+    def run(self) -> None:
+        """Run "notmuch tag --batch", with one line of input per tag operation"""
+        subprocess.run(['notmuch', 'tag', '--batch'], input='\n'.join(self.batch) + '\n',
+                stdout=subprocess.PIPE, encoding='utf8')
+
+
+def _batch_line(tag_expr: str, query: str) -> str:
+    """Format a tag expression and query as a line of input for "notmuch tag --batch"
+
+    In batch mode, notmuch expects tags to be hex-encoded, i.e. any characters other than
+    letters, digits, and a few pieces of punctuation are written as %XX."""
+
+    ops = []
+    for op in tag_expr.split():
+        tag = ''.join(c if c.isascii() and (c.isalnum() or c in '+-_@=.,:') else
+                      ''.join(f'%{b:02x}' for b in c.encode('utf8'))
+                      for c in op[1:])
+        ops.append(op[0] + tag)
+    return ' '.join(ops) + ' -- ' + query
+
+
 class Dodo(QApplication):
     """The main Dodo application
 
@@ -73,7 +106,9 @@ class Dodo(QApplication):
         # find a load config.py
         self.config_file = QStandardPaths.locate(QStandardPaths.StandardLocation.ConfigLocation, 'dodo/config.py')
         if self.config_file:
-            exec(open(self.config_file).read())
+            with open(self.config_file, 'rb') as f:
+                exec(compile(f.read(), self.config_file, 'exec'))
+            settings._apply_user_config()
         else:
             config_locs = QStandardPaths.standardLocations(QStandardPaths.StandardLocation.ConfigLocation)
             print('No config.py found in:\n' + '\n'.join([f'  {d}/dodo' for d in config_locs]))
@@ -98,6 +133,19 @@ class Dodo(QApplication):
         self.command_bar = self.main_window.command_bar
         self.lastWindowClosed.connect(self.quit)
 
+        # tag operations waiting to be applied, see tag()
+        self.tag_queue: list[tuple[str, str, Optional[Callable[[], None]]]] = []
+        self.tag_thread: Optional[TagThread] = None
+        self.tag_timer = QTimer(self)
+        self.tag_timer.setSingleShot(True)
+        self.tag_timer.setInterval(50)
+        self.tag_timer.timeout.connect(self.apply_tags)
+        self.aboutToQuit.connect(self.finish_tagging)
+
+        # the sync or index job that is running, if any, see index_mail()
+        self.mail_thread: Optional[SyncMailThread] = None
+        self.index_pending = False
+
         # set timer to sync email periodically
         if settings.sync_mail_interval != -1:
             self.sync_mail()
@@ -105,6 +153,10 @@ class Dodo(QApplication):
             timer.timeout.connect(self.sync_mail)
             timer.start(settings.sync_mail_interval * 1000)
 
+        # watch the Maildir for mail delivered by other programs
+        if settings.sync_mail_detector == 'fsnotify':
+            self.watch_maildir()
+
         # open init_queries and make un-closeable
         #
         for query in settings.init_queries:
@@ -240,11 +292,60 @@ class Dodo(QApplication):
         def callback(tag_expr: str) -> None:
             w = self.tabs.currentWidget()
             if w and isinstance(w, panel.Panel):
-                if isinstance(w, search.SearchPanel): w.tag_thread(tag_expr, mode)
-                elif isinstance(w, thread.ThreadPanel): w.tag_message(tag_expr)
-                w.refresh()
+                # search and thread panels refresh themselves once the tags have been applied
+                if isinstance(w, search.SearchPanel):
+                    w.tag_thread(tag_expr, mode)
+                elif isinstance(w, thread.ThreadPanel):
+                    w.tag_message(tag_expr)
+                else:
+                    w.refresh()
         self.command_bar.open(mode, callback)
 
+    def tag(self, tag_expr: str, query: str, done: Optional[Callable[[], None]]=None) -> None:
+        """Apply the given tag expression to all messages matching the query
+
+        Tagging happens in the background. Operations requested in quick succession (e.g. by
+        holding down a key) are collected and applied by a single call to "notmuch tag --batch".
+
+        :param tag_expr: one or more statements of the form "+TAG" or "-TAG", separated by whitespace
+        :param query: a notmuch query
+        :param done: called once the tags have been applied
+        """
+
+        self.tag_queue.append((tag_expr, query, done))
+        self.tag_timer.start()
+
+    def apply_tags(self) -> None:
+        """Start applying all of the queued tag operations
+
+        If a batch is already being applied, the queued operations wait for it to finish."""
+
+        if self.tag_thread or not self.tag_queue: return
+        queue = self.tag_queue
+        self.tag_queue = []
+        t = TagThread([_batch_line(tag_expr, query) for tag_expr, query, _ in queue], parent=self)
+
+        def done() -> None:
+            self.tag_thread = None
+            t.deleteLater()
+            for _, _, callback in queue:
+                if callback: callback()
+            self.apply_tags()
+
+        self.tag_thread = t
+        t.finished.connect(done)
+        t.start()
+
+    def finish_tagging(self) -> None:
+        """Apply any outstanding tag operations before exiting"""
+
+        self.tag_timer.stop()
+        if self.tag_thread:
+            self.tag_thread.wait()
+        if self.tag_queue:
+            TagThread([_batch_line(tag_expr, query) for tag_expr, query, _ in self.tag_queue]).run()
+            self.tag_queue = []
+
     def sync_mail(self, quiet: bool=True) -> None:
         """Sync mail with IMAP server
 
@@ -261,15 +362,79 @@ class Dodo(QApplication):
             if not quiet:
                 title = self.main_window.windowTitle()
                 self.main_window.setWindowTitle(title.replace(' [syncing]', ''))
-            t.deleteLater()
+            self.mail_thread_done(t)
 
         if not quiet:
             title = self.main_window.windowTitle()
             self.main_window.setWindowTitle(title + ' [syncing]')
 
+        self.mail_thread = t
         t.finished.connect(done)
         t.start()
 
+    def watch_maildir(self) -> None:
+        """Watch the `new` folders of the Maildir and index mail when it arrives
+
+        New files are picked up by a :class:`QFileSystemWatcher`. Since deliveries tend to
+        come in bunches, :func:`~dodo.app.Dodo.index_mail` is only called once the folders have
+        been quiet for 2 seconds. Files leaving `new` (e.g. when notmuch moves a message to
+        `cur` after it is read) are ignored."""
+
+        dirs = []
+        for d, subdirs, _ in os.walk(util.notmuch_mail_root()):
+            if 'new' in subdirs and 'cur' in subdirs:
+                dirs.append(os.path.join(d, 'new'))
+            subdirs[:] = [s for s in subdirs if s not in ('new', 'cur', 'tmp', '.notmuch')]
+
+        self.maildir_contents = {d: set(os.listdir(d)) for d in dirs}
+        self.maildir_timer = QTimer(self)
+        self.maildir_timer.setSingleShot(True)
+        self.maildir_timer.setInterval(2000)
+        self.maildir_timer.timeout.connect(self.index_mail)
+        self.maildir_watcher = QFileSystemWatcher(dirs, self)
+        self.maildir_watcher.directoryChanged.connect(self.maildir_changed)
+
+    def maildir_changed(self, path: str) -> None:
+        """Start the timer for :func:`index_mail` if new files have appeared in the given folder"""
+
+        try:
+            contents = set(os.listdir(path))
+        except OSError:
+            contents = set()
+        if not contents.issubset(self.maildir_contents.get(path, set())):
+            self.maildir_timer.start()
+        self.maildir_contents[path] = contents
+
+    def index_mail(self) -> None:
+        """Run 'notmuch new' in the background, then refresh panels
+
+        Only one 'notmuch new' can have the database open for writing, so if a sync or index
+        is already running, this runs again once it has finished."""
+
+        if self.mail_thread:
+            self.index_pending = True
+            return
+
+        t = SyncMailThread(parent=self, fetch=False)
+
+        def done() -> None:
+            self.refresh_panels()
+            self.mail_thread_done(t)
+
+        self.mail_thread = t
+        t.finished.connect(done)
+        t.start()
+
+    def mail_thread_done(self, t: SyncMailThread) -> None:
+        """Clean up after a sync or index, and index again if that was asked for meanwhile"""
+
+        t.deleteLater()
+        if self.mail_thread is t:
+            self.mail_thread = None
+        if self.index_pending and not self.mail_thread:
+            self.index_pending = False
+            self.index_mail()
+
     def num_panels(self) -> int:
         """Returns the number of panels (i.e. tabs) currently open"""
 
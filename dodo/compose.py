@@ -274,12 +274,12 @@ class ComposePanel(panel.Panel):
         return settings.smtp_accounts[self.current_account]
 
     def email_address(self) -> str:
-        """Return email address that should be used in From: header"""
+        """Return email address that should be used in From: header
 
-        if isinstance(settings.email_address, dict):
-            return settings.email_address[self.account_name()]
-        else:
-            return settings.email_address
+        This is empty if :func:`~dodo.settings.email_address` has no entry for the current
+        account, in which case sending the message reports an error."""
+
+        return settings._email_addresses.get(self.account_name(), '')
 
     def next_account(self) -> None:
         """Cycle to the next SMTP account in :func:`~dodo.settings.smtp_accounts`"""
@@ -368,6 +368,14 @@ class SendmailThread(QThread):
     def run(self) -> None:
         try:
             account = self.panel.account_name()
+            missing = [name for name, values in [('email_address', settings._email_addresses),
+                                                 ('sent_dir', settings._sent_dirs)]
+                       if account not in values]
+            if missing:
+                self.panel.set_status(f"{' and '.join(missing)} not set for account {account}",
+                                      color="fg_bad")
+                return
+
             eml = typing.cast(email.message.EmailMessage, email.message_from_string(
                 self.panel.message_string,
                 policy = email.policy.EmailPolicy(utf8=False)))
@@ -420,7 +428,7 @@ class SendmailThread(QThread):
             if self.panel.pgp_sign:
                 eml = pgp_util.sign(eml)
 
-            cmd = settings.send_mail_command.replace('{account}', account)
+            cmd = settings._send_mail_commands[account]
             sendmail = Popen(cmd, stdin=PIPE, encoding='utf8', shell=True)
             if sendmail.stdin:
                 sendmail.stdin.write(eml.as_string())
@@ -428,10 +436,7 @@ class SendmailThread(QThread):
             sendmail.wait(30)
             if sendmail.returncode == 0:
                 # save to sent folder
-                if isinstance(settings.sent_dir, dict):
-                    sent_dir = settings.sent_dir[account]
-                else:
-                    sent_dir = settings.sent_dir
+                sent_dir = settings._sent_dirs[account]
                 # None means we should discard the email, presumably because it's already
                 # handled by whatever mechanism sends it in the first place
                 if sent_dir is not None:
@@ -121,9 +121,9 @@ class Panel(QWidget):
         """
 
         logger.info('before_close: starting')
-        if settings.remove_temp_dirs == 'always':
+        if settings.remove_temp_dirs is settings.TempDirPolicy.ALWAYS:
             for d in self.temp_dirs: shutil.rmtree(d)
-        elif settings.remove_temp_dirs == 'ask':
+        elif settings.remove_temp_dirs is settings.TempDirPolicy.ASK:
             if len(self.temp_dirs) != 0:
                 q = "The following temp dirs were created:\n"
                 for d in self.temp_dirs:
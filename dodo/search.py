@@ -17,63 +17,291 @@
 # along with Dodo. If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
-from typing import Optional, Any, overload, Literal
+from typing import Optional, Any, overload, Literal, Iterable, Callable
 
 from PyQt6.QtCore import Qt, QAbstractItemModel, QModelIndex, QObject, QSettings
 from PyQt6.QtWidgets import QTreeView, QWidget, QAbstractSlider
-from PyQt6.QtGui import QFont, QColor
-import subprocess
-import json
+from PyQt6.QtGui import QFont
 import logging
+import time
+import datetime
 
 from . import app
 from . import settings
 from . import keymap
 from . import thread
 from . import panel
+from . import themes
+from . import util
 
 logger = logging.getLogger(__name__)
 
 columns = ['date', 'from', 'subject', 'tags']
 
+# search results also have tooltips
+_data_roles = util.model_data_roles | {Qt.ItemDataRole.ToolTipRole}
+
+# threads with any of these tags are shown in bold
+_bold_tags = frozenset({'unread', 'flagged'})
+
+# SearchModel.refresh resets the model when the runs of rows to insert or remove, plus the
+# rows to move, number more than this
+_max_row_changes = 100
+
+def _count_runs(ids: list[str], others: set[str]) -> int:
+    """Count the runs of consecutive ids which are not in `others`"""
+    runs = 0
+    prev_in = True
+    for tid in ids:
+        is_in = tid in others
+        if not is_in and prev_in: runs += 1
+        prev_in = is_in
+    return runs
+
 class SearchModel(QAbstractItemModel):
     """A model containing the results of a search"""
 
     def __init__(self, q: str) -> None:
         super().__init__()
         self.q = q
+        # a search for 'tag:TAG' doesn't bother showing TAG in the tags column
+        self._query_hides_tag = q[4:] if q.startswith('tag:') else None
+        # for a search like 'tag:inbox and tag:unread', the tags a thread needs to match it
+        terms = [t for t in q.split() if t.lower() != 'and']
+        self._query_tags: Optional[frozenset[str]] = None
+        if terms and all(t.startswith('tag:') and len(t) > 4 and not '(' in t and not ')' in t
+                         and not '"' in t for t in terms):
+            self._query_tags = frozenset(t[4:] for t in terms)
+
+        # fonts for each column, as a tuple (normal, bold)
+        self._fonts = []
+        for col in columns:
+            if col == 'tags':
+                normal = QFont(settings.tag_font, settings.tag_font_size)
+            else:
+                normal = QFont(settings.search_font, settings.search_font_size)
+            bold = QFont(normal)
+            bold.setBold(True)
+            self._fonts.append((normal, bold))
+
+        # foreground colors for each column, as a tuple (normal, unread, flagged), where
+        # unread and flagged are None if the theme doesn't define them
+        theme = settings.theme
+        self._fg_colors = []
+        for col in columns:
+            normal, unread, flagged = ('fg_' + col, 'fg_' + col + '_unread', 'fg_' + col + '_flagged')
+            self._fg_colors.append((
+                themes.qcolor(theme[normal] if normal in theme else theme['fg']),
+                themes.qcolor(theme[unread]) if unread in theme else None,
+                themes.qcolor(theme[flagged]) if flagged in theme else None))
+
+        # override colors from settings.search_color_overrides, as a list of colors (or None)
+        # for each column
+        self._override_fg = {
+            tag: [themes.qcolor(colors[col]) if col in colors else None for col in columns]
+            for tag, colors in settings.search_color_overrides.items()
+        }
+        self._override_tags = frozenset(self._override_fg)
+
+        self.d: list[dict] = []
+        self.threads: dict[str, int] = {}
+        self._tag_strs: list[str] = []
+        self._tagsets: list[frozenset[str]] = []
+        self._revision: Optional[str] = None
+        self._dates_expire = 0.0
         self.refresh()
 
     def refresh(self) -> None:
-        """Refresh the model by (re-) running "notmuch search"."""
+        """Refresh the model by (re-) running "notmuch search".
+
+        Rather than resetting the model, the old and new lists of thread ids are compared
+        and only the rows which were actually inserted or removed are signalled as such.
+        This lets Qt keep track of the selection and scroll position on its own."""
+
+        # skip the search if the database hasn't changed, unless the relative dates shown in
+        # the first column are out of date
+        revision = util.notmuch_revision()
+        if revision and revision == self._revision and time.time() < self._dates_expire:
+            logger.info("Database unchanged, skipping search refresh for '%s'", self.q)
+            return
+
         logger.info("Beginning search refresh for '%s'", self.q)
-        self.beginResetModel()
-        r = subprocess.run(['notmuch', 'search', '--format=json', self.q],
-                stdout=subprocess.PIPE)
-        self.json_str = r.stdout.decode('utf-8')
-        self.d = json.loads(self.json_str)
-        self.threads = {thread['thread']: i for i,thread in enumerate(self.d)}
-        self.endResetModel()
+        d = util.notmuch_json(['search', '--format=json', self.q])
+        tag_strs = [self._tag_string(thread) for thread in d]
+        tagsets = [frozenset(thread['tags']) for thread in d]
+
+        old_ids = [thread['thread'] for thread in self.d]
+        new_ids = [thread['thread'] for thread in d]
+        old_set = set(old_ids)
+        new_set = set(new_ids)
+
+        # Threads are unique, so rows can be matched up by id. Threads only in the old list are
+        # removed, threads only in the new list are inserted, and a thread that appears earlier
+        # than in the old list (e.g. because a new message bumped it to the top) is moved.
+        kept = [tid for tid in old_ids if tid in new_set]
+        moved = set()
+        k = 0
+        for tid in new_ids:
+            if tid in old_set:
+                while kept[k] in moved: k += 1
+                if kept[k] == tid:
+                    k += 1
+                else:
+                    moved.add(tid)
+
+        changes = len(moved) + _count_runs(old_ids, new_set) + _count_runs(new_ids, old_set)
+        if changes > _max_row_changes:
+            # signalling each change would cost more than letting the view start over
+            self.beginResetModel()
+            self.d = d
+        else:
+            # remove runs of old threads, going backwards so the row numbers stay valid
+            i2 = len(old_ids)
+            while i2 > 0:
+                if old_ids[i2-1] in new_set:
+                    i2 -= 1
+                    continue
+                i1 = i2 - 1
+                while i1 > 0 and old_ids[i1-1] not in new_set: i1 -= 1
+                self._remove_rows(i1, i2)
+                i2 = i1
+
+            # the rows are now the kept threads, so walk the new list inserting and moving
+            # threads into place
+            j = 0
+            while j < len(new_ids):
+                tid = new_ids[j]
+                if tid not in old_set:
+                    j2 = j + 1
+                    while j2 < len(new_ids) and new_ids[j2] not in old_set: j2 += 1
+                    self._insert_rows(j, d[j:j2], tag_strs[j:j2], tagsets[j:j2])
+                    j = j2
+                    continue
+                if tid in moved:
+                    row = next(i for i in range(j, len(self.d)) if self.d[i]['thread'] == tid)
+                    self._move_row(row, j)
+                j += 1
+
+        # the thread ids now line up, so swap in the new data and let the view repaint
+        self.d = d
+        self._tag_strs = tag_strs
+        self._tagsets = tagsets
+        self.threads = {thread['thread']: i for i,thread in enumerate(d)}
+        if changes > _max_row_changes:
+            self.endResetModel()
+        elif d:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(d)-1, len(columns)-1))
+        self._revision = revision
+        self._dates_expire = self._relative_dates_expire()
+        logger.info("Search refreshed for '%s'", self.q)
+
+    def _remove_rows(self, i1: int, i2: int) -> None:
+        self.beginRemoveRows(QModelIndex(), i1, i2-1)
+        del self.d[i1:i2]
+        del self._tag_strs[i1:i2]
+        del self._tagsets[i1:i2]
+        self.endRemoveRows()
+
+    def _insert_rows(self, row: int, d: list[dict], tag_strs: list[str], tagsets: list[frozenset[str]]) -> None:
+        self.beginInsertRows(QModelIndex(), row, row + len(d) - 1)
+        self.d[row:row] = d
+        self._tag_strs[row:row] = tag_strs
+        self._tagsets[row:row] = tagsets
+        self.endInsertRows()
+
+    def _move_row(self, row: int, dest: int) -> None:
+        """Move a row up to `dest`, keeping any index pointing at it (e.g. the selection) valid"""
+        self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), dest)
+        for l in (self.d, self._tag_strs, self._tagsets):
+            l.insert(dest, l.pop(row))
+        self.endMoveRows()
+
+    def _relative_dates_expire(self) -> float:
+        """Return the time when some relative date in the search results will change
+
+        notmuch shows dates in the last hour as e.g. '5 mins. ago', and older dates relative
+        to the current day (e.g. 'Today 10:30', 'Yest. 10:30'), so these change every
+        minute or at midnight, respectively."""
+
+        now = time.time()
+        if any(now - thread['timestamp'] < 3600 for thread in self.d):
+            return now + 60
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        return datetime.datetime.combine(tomorrow, datetime.time()).timestamp()
+
+    def _tag_string(self, thread: dict) -> str:
+        """Return the contents of the 'tags' column for the given thread JSON object
+
+        These are computed once per refresh, rather than every time the view asks for them."""
+
+        hidden = self._query_hides_tag
+        icons = settings.tag_icons
+        hide_tags = settings.hide_tags
+        return ' '.join(icons[t] if t in icons else f'[{t}]'
+                        for t in thread['tags'] if t not in hide_tags and t != hidden)
 
     def refresh_thread(self, thread: QModelIndex|str):
+        """Refresh a single thread, given either by its model index or its notmuch thread id"""
+
         if isinstance(thread, str):
             thread_id = thread
-            row = self.threads[thread]
         else:
             thread_id = self.thread_id(thread)
-            row = thread.row()
             assert thread_id is not None
 
-        r = subprocess.run(['notmuch', 'search', '--format=json', f'{self.q} AND thread:{thread_id}'],
-                stdout=subprocess.PIPE)
-        contents = json.loads(r.stdout.decode('utf-8'))
+        self.refresh_threads([thread_id])
+
+    def refresh_threads(self, thread_ids: Iterable[str]) -> None:
+        """Refresh the given threads using a single call to "notmuch search"
 
-        self.beginResetModel()
-        self.d[row:row+1] = contents
-        self.threads = {thread['thread']: i for i,thread in enumerate(self.d)}
-        self.endResetModel()
+        Threads which no longer match the query are removed from the model. The threads
+        must already be in the model, i.e. in :attr:`threads`."""
+
+        rows = sorted(self.threads[tid] for tid in thread_ids)
+        if len(rows) == 0: return
+
+        thread_q = ' OR '.join('thread:' + self.d[row]['thread'] for row in rows)
+        contents = {t['thread']: t for t in
+                util.notmuch_json(['search', '--format=json', f'({self.q}) AND ({thread_q})'])}
+
+        # go backwards, so removing a row doesn't shift the rows still to be updated
+        first_removed = -1
+        for row in reversed(rows):
+            thread_id = self.d[row]['thread']
+            t = contents.get(thread_id)
+            if t:
+                self.d[row] = t
+                self._tag_strs[row] = self._tag_string(t)
+                self._tagsets[row] = frozenset(t['tags'])
+                self.dataChanged.emit(self.index(row, 0), self.index(row, len(columns)-1))
+            else:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self.d[row]
+                del self._tag_strs[row]
+                del self._tagsets[row]
+                del self.threads[thread_id]
+                self.endRemoveRows()
+                first_removed = row
+
+        # only the rows after a removed row have moved, so only re-index those
+        if first_removed != -1:
+            for i in range(first_removed, len(self.d)):
+                self.threads[self.d[i]['thread']] = i
         logger.info("Model refreshed for '%s'", self.q)
 
+    def apply_tags(self, row: int, tag_expr: str) -> bool:
+        """Apply a tag expression to the tags shown for a thread, until it is refreshed
+
+        Returns False if the thread no longer matches the search, as far as can be told from its
+        tags, and True otherwise."""
+
+        thread = self.d[row]
+        util.apply_tag_expr(thread['tags'], tag_expr)
+        self._tag_strs[row] = self._tag_string(thread)
+        self._tagsets[row] = frozenset(thread['tags'])
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(columns)-1))
+        return self._query_tags is None or self._query_tags <= self._tagsets[row]
+
     def num_threads(self) -> int:
         """The number of threads returned by the search"""
 
@@ -83,23 +311,22 @@ class SearchModel(QAbstractItemModel):
         """Return a JSON object associated with the thread at the given model index"""
 
         row = index.row()
-        if row >= 0 and row < len(self.d):
-            return self.d[row]
-        else:
-            return None
+        d = self.d
+        return d[row] if 0 <= row < len(d) else None
 
     def thread_id(self, index: QModelIndex) -> Optional[str]:
         """Return the notmuch thread id associated with the thread at the given model index"""
 
-        thread = self.thread_json(index)
-        if thread and 'thread' in thread:
-            return thread['thread']
-        else:
-            return None
+        row = index.row()
+        d = self.d
+        return d[row]['thread'] if 0 <= row < len(d) else None
 
     def data(self, index: QModelIndex, role: int=Qt.ItemDataRole.DisplayRole) -> Any:
         """Overrides `QAbstractItemModel.data` to populate a view with search results"""
 
+        if role not in _data_roles:
+            return None
+
         global columns
         if index.row() >= len(self.d) or index.column() >= len(columns):
             return None
@@ -115,38 +342,25 @@ class SearchModel(QAbstractItemModel):
             elif col == 'subject':
                 return thread_d['subject']
             elif col == 'tags':
-                tag_icons = []
-                for t in thread_d['tags']:
-                    # don't bother showing TAG if it is in settings.hide_tags or the query is specifically 'tag:TAG'
-                    if t not in settings.hide_tags and self.q != 'tag:' + t:
-                        tag_icons.append(settings.tag_icons[t] if t in settings.tag_icons else f'[{t}]')
-                return ' '.join(tag_icons)
+                return self._tag_strs[index.row()]
         elif role == Qt.ItemDataRole.FontRole:
-            if col == 'tags':
-                font = QFont(settings.tag_font, settings.tag_font_size)
-            else:
-                font = QFont(settings.search_font, settings.search_font_size)
-
-            if 'unread' in thread_d['tags'] or 'flagged' in thread_d['tags']:
-                font.setBold(True)
-            return font
+            normal, bold = self._fonts[index.column()]
+            return normal if self._tagsets[index.row()].isdisjoint(_bold_tags) else bold
         elif role == Qt.ItemDataRole.ForegroundRole:
-            for tag in settings.search_color_overrides.keys() & thread_d['tags']:
-                if col in settings.search_color_overrides[tag]:
-                    color = settings.search_color_overrides[tag][col]
-                    return QColor(color)
-
-            color = 'fg_' + col
-            unread_color = 'fg_' + col + '_unread'
-            flagged_color = 'fg_' + col + '_flagged'
-            if 'unread' in thread_d['tags'] and unread_color in settings.theme:
-                return QColor(settings.theme[unread_color])
-            elif 'flagged' in thread_d['tags'] and flagged_color in settings.theme:
-                return QColor(settings.theme[flagged_color])
-            elif color in settings.theme:
-                return QColor(settings.theme[color])
+            column = index.column()
+            tags = self._tagsets[index.row()]
+            for tag in self._override_tags & tags:
+                override = self._override_fg[tag][column]
+                if override is not None:
+                    return override
+
+            normal, unread, flagged = self._fg_colors[column]
+            if unread is not None and 'unread' in tags:
+                return unread
+            elif flagged is not None and 'flagged' in tags:
+                return flagged
             else:
-                return QColor(settings.theme['fg'])
+                return normal
         elif role == Qt.ItemDataRole.ToolTipRole and col == 'tags':
             return ' '.join(thread_d['tags'])
 
@@ -196,8 +410,14 @@ class SearchPanel(panel.Panel):
         self.set_keymap(keymap.search_keymap)
         self.q = q
         self.conf = QSettings("dodo", "dodo")
+        # header state is read once here, and only written back to QSettings on close
+        self._saved_tree_geometry = self.conf.value("search_tree_geometry")
         self.tree = QTreeView()
         self.tree.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        # every row has the same fonts, so let Qt skip measuring them one at a time
+        self.tree.setUniformRowHeights(True)
+        self.tree.setRootIsDecorated(False)
+        self.tree.setItemsExpandable(False)
         self.setStyleSheet(f'QTreeView::item {{ padding: {settings.search_view_padding}px }}')
         self.model = SearchModel(q)
         self.tree.setModel(self.model)
@@ -213,12 +433,12 @@ class SearchPanel(panel.Panel):
         return super().before_close()
 
     def restore_tree_geometry(self):
-        tree_geometry = self.conf.value("search_tree_geometry")
-        if tree_geometry:
-            self.tree.header().restoreState(tree_geometry)
+        if self._saved_tree_geometry:
+            self.tree.header().restoreState(self._saved_tree_geometry)
 
     def save_tree_geometry(self):
-        self.conf.setValue("search_tree_geometry", self.tree.header().saveState())
+        self._saved_tree_geometry = self.tree.header().saveState()
+        self.conf.setValue("search_tree_geometry", self._saved_tree_geometry)
 
     def focusInEvent(self, event: PyQt6.QWidget.QFocusEvent):
         self.refresh_threads()
@@ -229,27 +449,35 @@ class SearchPanel(panel.Panel):
         if self.updated_threads.difference(self.model.threads.keys()):
             self.dirty = True
         else:
-            current = self.tree.currentIndex()
-            for tid in self.updated_threads:
-                self.model.refresh_thread(tid)
-            if current.row() >= self.model.num_threads():
-                self.last_thread()
-            else:
-                self.tree.setCurrentIndex(current)
+            self._keep_position(lambda: self.model.refresh_threads(self.updated_threads))
         self.updated_threads.clear()
 
-    def refresh(self) -> None:
-        """Refresh the search listing and restore the selection, if possible."""
+    def _keep_position(self, update: Callable[[], None]) -> None:
+        """Run the given model update, keeping the cursor in place if its thread goes away
+
+        The model signals row insertions and removals, so Qt already keeps the current index
+        on the same thread. When that thread is removed, Qt would move up to the previous row,
+        whereas we want the cursor to stay put, landing on the next thread. After many changes
+        the model is reset instead, in which case the thread is selected again here."""
 
         current = self.tree.currentIndex()
-        self.model.refresh()
-        self.restore_tree_geometry()
-        
-        if current.row() >= self.model.num_threads():
-            self.last_thread()
+        thread_id = self.model.thread_id(current)
+        update()
+        if thread_id is None:
+            return
+        if thread_id in self.model.threads:
+            if not self.tree.currentIndex().isValid():
+                self.tree.setCurrentIndex(self.model.index(self.model.threads[thread_id], 0))
         else:
-            self.tree.setCurrentIndex(current)
+            if current.row() >= self.model.num_threads():
+                self.last_thread()
+            else:
+                self.tree.setCurrentIndex(self.model.index(current.row(), 0))
+
+    def refresh(self) -> None:
+        """Refresh the search listing, keeping the selection on the same thread if possible."""
 
+        self._keep_position(self.model.refresh)
         super().refresh()
 
     def update_thread(self, thread_id: str, msg_id: str|None= None) -> None:
@@ -271,16 +499,7 @@ class SearchPanel(panel.Panel):
         :param unread: if True, this will jump to the next unread thread
         """
 
-        row = self.tree.currentIndex().row()
-        while True:
-            row += 1
-            i = self.tree.model().index(row, 0)
-            thread = self.model.thread_json(i)
-            if not thread:
-                break
-            elif not unread or (thread and 'tags' in thread and 'unread' in thread['tags']):
-                self.tree.setCurrentIndex(i)
-                break
+        self._select_first(range(self.tree.currentIndex().row() + 1, self.model.num_threads()), unread)
 
     def previous_thread(self, unread: bool=False) -> None:
         """Select the previous thread in the search
@@ -288,16 +507,26 @@ class SearchPanel(panel.Panel):
         :param unread: if True, this will jump to the previous unread thread
         """
 
-        row = self.tree.currentIndex().row()
-        while True:
-            row -= 1
-            i = self.tree.model().index(row, 0)
-            thread = self.model.thread_json(i)
-            if not thread:
-                break
-            elif not unread or ('tags' in thread and 'unread' in thread['tags']):
-                self.tree.setCurrentIndex(i)
-                break
+        self._select_first(range(self.tree.currentIndex().row() - 1, -1, -1), unread)
+
+    def _select_first(self, rows: range, unread: bool) -> None:
+        """Select the first row in `rows`, or the first unread one if `unread` is True
+
+        This scans the search results directly, so only a single `QModelIndex` is constructed."""
+
+        model = self.model
+        d = model.d
+        found = -1
+        if not unread:
+            if len(rows) != 0: found = rows[0]
+        else:
+            for row in rows:
+                if 'unread' in d[row]['tags']:
+                    found = row
+                    break
+
+        if found != -1:
+            self.tree.setCurrentIndex(model.index(found, 0))
 
     def first_thread(self) -> None:
         """Select the first thread in the search"""
@@ -366,13 +595,17 @@ class SearchPanel(panel.Panel):
             tag_expr = '+' + tag_expr
         
         if mode == 'tag':
+            row = self.tree.currentIndex().row()
             thread_id = self.model.thread_id(self.tree.currentIndex())
             if thread_id:
-                subprocess.run(['notmuch', 'tag'] + tag_expr.split() + ['--', 'thread:' + thread_id])
-                self.app.update_single_thread(thread_id)
+                self.app.tag(tag_expr, 'thread:' + thread_id,
+                        lambda: self.app.update_single_thread(thread_id))
+                # Tagging happens in the background, so show the new tags right away. If the
+                # thread drops out of the search, move on as if it had already been removed.
+                if not self.model.apply_tags(row, tag_expr):
+                    self.next_thread()
         elif mode == 'tag marked':
-            subprocess.run(['notmuch', 'tag'] + tag_expr.split() + ['-marked','--', f'tag:marked AND ({self.q})'])
-            self.app.refresh_panels()
+            self.app.tag(tag_expr + ' -marked', f'tag:marked AND ({self.q})', self.app.refresh_panels)
 
 
 
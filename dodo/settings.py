@@ -34,7 +34,14 @@ defaults, as detailed below.
 """
 
 from . import themes
-from typing import Literal, Dict, Union
+from typing import Literal, Dict, Union, Optional, FrozenSet, Tuple
+import enum
+import sys
+import types
+import email.utils
+import logging
+
+logger = logging.getLogger(__name__)
 
 # functional
 email_address: Union[str, Dict[str, str]] = ''
@@ -118,6 +125,16 @@ sync_mail_interval = 300
 Set this to -1 to disable automatic syncing.
 """
 
+sync_mail_detector: Literal['poll', 'fsnotify'] = 'poll'
+"""How to notice new mail that arrives between syncs
+
+With 'poll', new mail only shows up after :func:`~dodo.settings.sync_mail_command` runs,
+either periodically or when syncing manually. With 'fsnotify', Dodo also watches the `new`
+folders of your Maildir, and runs 'notmuch new' shortly after a message is delivered to one
+of them. This is useful if mail is fetched by another program, e.g. an IMAP IDLE client, in
+which case :func:`~dodo.settings.sync_mail_interval` can be set much higher, or to -1.
+"""
+
 default_to_html = False
 """Open messages in HTML mode by default, rather than plaintext"""
 
@@ -132,12 +149,19 @@ wrap_column = 78
 """Wrap text to this column when composing emails
 """
 
-remove_temp_dirs = 'ask'
+class TempDirPolicy(enum.IntEnum):
+    """Possible values of :func:`~dodo.settings.remove_temp_dirs`"""
+    ALWAYS = 1
+    NEVER = 2
+    ASK = 3
+
+remove_temp_dirs: Union[TempDirPolicy, Literal['always', 'never', 'ask']] = TempDirPolicy.ASK
 """Set whether to remove temporary directories when closing a panel
 
 Thread panels create temporary directories to open attachments. These can be cleaned up
 automatically when a panel (or Dodo) is closed. Possible values are: 'always', 'never',
-or 'ask'.
+or 'ask'. These are converted to :class:`~dodo.settings.TempDirPolicy` once `config.py`
+has been loaded, so an invalid value is reported at startup.
 """
 
 default_thread_list_mode: Literal['conversation', 'thread'] = 'conversation'
@@ -198,7 +222,8 @@ html_confirm_open_links_trusted_hosts = []
 """A list of trusted hosts for HTML links.
 
 If a link is to a host in this list, it will be opened without confirmation, even if
-:func:`~dodo.settings.html_confirm_open_links` is True.
+:func:`~dodo.settings.html_confirm_open_links` is True. An entry of the form '*.domain.com'
+trusts all subdomains of 'domain.com'.
 """
 
 # visual
@@ -208,6 +233,9 @@ theme = themes.nord
 A theme is a dictionary mapping a dozen or so named colors to HEX values.
 Several themes are defined in `dodo.themes`, based on the popular Nord,
 Solarized and Gruvbox color palettes.
+
+Once `config.py` has been loaded, this is replaced by a read-only copy, since colors
+derived from it are cached by the panels.
 """
 
 search_font = 'DejaVu Sans Mono'
@@ -253,51 +281,66 @@ tag_icons = {
 """Tag icons
 
 This is a dictionary of substitutions used to abbreviate common tag names as unicode
-icons in the search and thread panels.
+icons in the search and thread panels. Like :func:`~dodo.settings.theme`, it is replaced
+by a read-only copy once `config.py` has been loaded.
 """
 
 hide_tags = ['unread', 'sent']
-"""Tags to hide in search panel"""
+"""Tags to hide in search panel
+
+This can be given as any collection of tag names. It is turned into a frozenset once
+`config.py` has been loaded, so it should be set there rather than changed later.
+"""
 
 message_css = """
+:root {{
+  --message-font: {message_font};
+  --message-font-size: {message_font_size}pt;
+  --fg: {fg};
+  --fg-bright: {fg_bright};
+  --fg-dim: {fg_dim};
+  --bg: {bg};
+  --bg-button: {bg_button};
+}}
+
 pre {{
-  font-family: {message_font};
-  font-size: {message_font_size}pt;
+  font-family: var(--message-font);
+  font-size: var(--message-font-size);
 }}
 
 pre .quoted {{
-  color: {fg_dim};
+  color: var(--fg-dim);
 }}
 
 pre .headername {{
-  color: {fg_bright};
+  color: var(--fg-bright);
   font-weight: bold;
 }}
 
 pre .headertext {{
-  color: {fg_bright};
+  color: var(--fg-bright);
 }}
 
 body {{
-  background-color: {bg};
-  color: {fg};
+  background-color: var(--bg);
+  color: var(--fg);
 }}
 
 ::-webkit-scrollbar {{
-  background: {bg};
+  background: var(--bg);
 }}
 
 ::-webkit-scrollbar-thumb {{
-  background: {bg_button};
+  background: var(--bg-button);
 }}
 
 ::selection {{
-  color: {bg};
-  background: {fg};
+  color: var(--bg);
+  background: var(--fg);
 }}
 
 a {{
-  color: {fg_bright};
+  color: var(--fg-bright);
 }}
 """
 """CSS used in view and compose window
@@ -305,6 +348,9 @@ a {{
 Placeholders may be included in curly brackets for any color named in the current theme, as
 well as {message_font} and {message_font_size}. Literal curly braces should be doubled, i.e.
 '{' should be '{{' and '}' should be '}}'.
+
+The default CSS fills in each placeholder once, as a CSS custom property on `:root`, e.g.
+`--fg-bright`. CSS appended to this setting can use these with `var(--fg-bright)`.
 """
 
 message2html_filters = []
@@ -319,8 +365,8 @@ The default rendering runs the following functions in order, which might also be
 when writing your own filters:
 
 - :func:`~dodo.util.body_text` (to get a body string from the JSON)
-- :func:`~dodo.util.simple_escape` (to make the string HTML-safe)
-- :func:`~dodo.util.colorize_text` (to colorize quoted text)
+- :func:`~dodo.util.text2html` (to make the string HTML-safe and colorize quoted text,
+  equivalent to :func:`~dodo.util.simple_escape` followed by :func:`~dodo.util.colorize_text`)
 - :func:`~dodo.util.linkify` (to detect URLs)
 
 Example configuration using this feature to highlight markdown syntax:
@@ -377,3 +423,70 @@ using the built-in Gruvbox palette:
       }
   }
 """
+
+
+# derived from the settings above by _apply_user_config()
+_send_mail_commands: Dict[str, str] = {}
+_email_addresses: Dict[str, str] = {}
+_sent_dirs: Dict[str, Optional[str]] = {}
+_my_addresses: FrozenSet[str] = frozenset()
+_account_by_address: Dict[str, int] = {}
+_trusted_hosts: FrozenSet[str] = frozenset()
+_trusted_host_suffixes: Tuple[str, ...] = ()
+
+def _apply_user_config() -> None:
+    """Normalize settings after `config.py` has been loaded
+
+    Some settings are converted to structures that are faster to use, while still allowing
+    them to be given in the simplest form in `config.py`. This is called once by
+    :class:`~dodo.app.Dodo` after loading the config file."""
+
+    global theme, tag_icons, hide_tags, remove_temp_dirs, smtp_accounts, email_address, sent_dir
+    global _send_mail_commands, _email_addresses, _sent_dirs, _my_addresses, _account_by_address
+    global _trusted_hosts, _trusted_host_suffixes
+    theme = types.MappingProxyType(dict(theme))
+    tag_icons = types.MappingProxyType(dict(tag_icons))
+    hide_tags = frozenset(hide_tags)
+
+    # account names are used as keys in several settings, so make them all the same object
+    smtp_accounts = [sys.intern(a) for a in smtp_accounts]
+    if isinstance(email_address, dict):
+        email_address = {sys.intern(a): v for a, v in email_address.items()}
+    if isinstance(sent_dir, dict):
+        sent_dir = {sys.intern(a): v for a, v in sent_dir.items()}
+    _send_mail_commands = {a: send_mail_command.replace('{account}', a) for a in smtp_accounts}
+
+    # email_address and sent_dir can be given globally or per account, so look them up
+    # for each account here, rather than checking which every time a message is sent.
+    # Accounts missing from a dict are left out, and sending from them reports an error.
+    for name, value in [('email_address', email_address), ('sent_dir', sent_dir)]:
+        if isinstance(value, dict):
+            missing = [a for a in smtp_accounts if a not in value]
+            if missing:
+                logger.warning("%s has no entry for the account(s): %s", name, ', '.join(missing))
+    _email_addresses = {a: email_address[a] if isinstance(email_address, dict) else email_address
+                        for a in smtp_accounts
+                        if not isinstance(email_address, dict) or a in email_address}
+    _sent_dirs = {a: sent_dir[a] if isinstance(sent_dir, dict) else sent_dir
+                  for a in smtp_accounts
+                  if not isinstance(sent_dir, dict) or a in sent_dir}
+
+    all_addresses = email_address.values() if isinstance(email_address, dict) else [email_address]
+    _my_addresses = frozenset(email.utils.parseaddr(e)[1] for e in all_addresses)
+    _account_by_address = {}
+    for i, a in enumerate(smtp_accounts):
+        if a in _email_addresses:
+            _account_by_address.setdefault(email.utils.parseaddr(_email_addresses[a])[1], i)
+
+    # hosts given as '*.domain' match by suffix, using str.endswith with a tuple
+    hosts = [h.lower() for h in html_confirm_open_links_trusted_hosts]
+    _trusted_hosts = frozenset(h for h in hosts if not h.startswith('*.'))
+    _trusted_host_suffixes = tuple(h[1:] for h in hosts if h.startswith('*.'))
+
+    if isinstance(remove_temp_dirs, str):
+        try:
+            remove_temp_dirs = TempDirPolicy[remove_temp_dirs.upper()]
+        except KeyError:
+            raise ValueError(f"remove_temp_dirs should be 'always', 'never', or 'ask', not '{remove_temp_dirs}'")
+    else:
+        remove_temp_dirs = TempDirPolicy(remove_temp_dirs)
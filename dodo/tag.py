@@ -19,84 +19,219 @@
 from __future__ import annotations
 from typing import Optional, Any, overload, Literal, List, Tuple
 
-from PyQt6.QtCore import Qt, QAbstractItemModel, QModelIndex, QObject
+from PyQt6.QtCore import Qt, QAbstractItemModel, QModelIndex, QObject, QThread, pyqtSignal
 from PyQt6.QtWidgets import QTreeView, QWidget
-from PyQt6.QtGui import QFont, QColor
+from PyQt6.QtGui import QFont
 import subprocess
 import json
+import os
+import concurrent.futures
 
 from . import app
 from . import settings
 from . import keymap
 from . import thread
 from . import panel
+from . import themes
+from . import util
+
+# notmuch2 is only needed to read tag counts without running notmuch, fall back on the CLI when not present
+try:
+    import notmuch2
+except ImportError:
+    notmuch2 = None
 
 columns = ['date', 'from', 'subject', 'tags']
 
+# at most this many "notmuch count" processes are run at once, each with at least
+# _min_queries_per_worker queries, so a short list of tags still uses a single process
+_count_workers = min(4, os.cpu_count() or 1)
+_min_queries_per_worker = 64
+
+def _count_batch(queries: List[str]) -> List[int]:
+    """Run "notmuch count --batch" on the given queries, returning one count per query"""
+
+    r = subprocess.run(['notmuch', 'count', '--batch', '--output=threads'],
+            input=''.join(q + '\n' for q in queries).encode('utf-8'), stdout=subprocess.PIPE)
+    # the counts are plain ASCII digits, which int() accepts as bytes
+    return [int(c) for c in r.stdout.split()]
+
+TagCounts = Tuple[List[str], List[int], List[int]]
+"""Tag names, with the number of unread and total threads for each, as parallel lists"""
+
+def _search_tags(query: str) -> List[str]:
+    """Return the tags occurring on messages matching the given query"""
+
+    r = subprocess.run(['notmuch', 'search', '--output=tags', query],
+            stdout=subprocess.PIPE)
+    return [t.decode('utf-8') for t in r.stdout.splitlines()]
+
+def _tag_counts_notmuch2() -> TagCounts:
+    """Return lists of tags, unread threads, and total threads using the notmuch2 bindings
+
+    The tags are listed by :func:`_search_tags`, as for :func:`_tag_counts_cli`, so tags which
+    only occur on excluded messages are left out either way."""
+
+    tags = _search_tags('*')
+    with notmuch2.Database(mode=notmuch2.Database.MODE.READ_ONLY) as db:
+        # the CLI leaves out messages with excluded tags by default, so do the same
+        exclude = [t for t in db.config.get('search.exclude_tags', '').split(';') if t]
+        unread = []
+        total = []
+        for t in tags:
+            q = 'tag:"' + t.replace('"', '""') + '"'
+            total.append(db.count_threads(q, exclude_tags=exclude))
+            unread.append(db.count_threads(q + ' AND tag:unread', exclude_tags=exclude))
+        return tags, unread, total
+
+def _tag_counts_cli() -> TagCounts:
+    """Return lists of tags, unread threads, and total threads using the notmuch CLI
+
+    The thread counts are computed by "notmuch count --batch", which reads one query
+    per line and writes one count per line. For many tags, the queries are split between
+    a few of these processes, which run in parallel.
+
+    Most tags usually have no unread mail, so the tags of unread messages are listed first,
+    and unread threads are only counted for those. The rest have 0 unread threads."""
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as ex:
+        all_tags = ex.submit(_search_tags, '*')
+        unread_tags = ex.submit(_search_tags, 'tag:unread')
+        tags = all_tags.result()
+        has_unread = set(unread_tags.result())
+
+    queries = []
+    for t in tags:
+        q = 'tag:"' + t.replace('"', '""') + '"'
+        queries.append(q)
+        if t in has_unread:
+            queries.append(q + ' AND tag:unread')
+    workers = min(_count_workers, -(-len(queries) // _min_queries_per_worker))
+    if workers <= 1:
+        counts = _count_batch(queries)
+    else:
+        size = -(-len(queries) // workers)
+        chunks = [queries[i:i+size] for i in range(0, len(queries), size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+            counts = [c for chunk_counts in ex.map(_count_batch, chunks) for c in chunk_counts]
+
+    unread = []
+    total = []
+    it = iter(counts)
+    for t in tags:
+        total.append(next(it))
+        unread.append(next(it) if t in has_unread else 0)
+    return tags, unread, total
+
+class TagCountThread(QThread):
+    """A QThread used for reading tags and their thread counts
+
+    Used by :func:`~dodo.tag.TagModel.refresh`, so the GUI isn't blocked while the counts are
+    read. The tags are listed by "notmuch search". If the notmuch2 Python bindings are
+    installed, the counts are read directly from the database, otherwise by "notmuch count".
+    Either way, the counts are only recomputed if the database has changed since they were
+    last read."""
+
+    def __init__(self, parent: Optional[QObject]=None) -> None:
+        super().__init__(parent)
+        self.revision = ''
+        self.counts: Optional[TagCounts] = None
+
+    def run(self) -> None:
+        self.revision = util.notmuch_revision()
+        cache = TagModel._cache
+        if self.revision and cache and cache[0] == self.revision:
+            self.counts = cache[1]
+        elif notmuch2:
+            try:
+                self.counts = _tag_counts_notmuch2()
+            except notmuch2.NotmuchError:
+                self.counts = _tag_counts_cli()
+        else:
+            self.counts = _tag_counts_cli()
+
 class TagModel(QAbstractItemModel):
     """A model containing all tags"""
 
+    # the most recently computed counts, as a pair (database revision, counts), shared
+    # by all tag panels
+    _cache: Optional[Tuple[str, TagCounts]] = None
+
+    refreshed = pyqtSignal()
+    """Emitted when new counts have been loaded by :func:`refresh`"""
+
     def __init__(self) -> None:
         super().__init__()
+        self._counts: TagCounts = ([], [], [])
+        self._tags, self._unread, self._total = self._counts
+        self._count_strs: List[str] = []
+        self._runner = util.ThreadRunner(self, TagCountThread, self._counted)
+
+        # fonts and colors returned by data(), for tags with and without unread mail
+        self._font = QFont(settings.search_font, settings.search_font_size)
+        self._font_bold = QFont(self._font)
+        self._font_bold.setBold(True)
+        self._fg = themes.qcolor(settings.theme['fg'])
+        self._fg_unread = themes.qcolor(settings.theme['fg_subject_unread'])
         self.refresh()
 
     def refresh(self) -> None:
-        """Refresh the model by (re-) running "notmuch search"."""
-        self.beginResetModel()
-        r = subprocess.run(['notmuch', 'search', '--output=tags', '*'],
-                stdout=subprocess.PIPE)
-        tag_str = r.stdout.decode('utf-8')
+        """Refresh the model with the current tags and thread counts
+
+        The counts are read in the background by a :class:`TagCountThread`, and the
+        :attr:`refreshed` signal is emitted once they have been loaded into the model. If
+        a refresh is already running, another one is started when it finishes."""
 
-        self.d: List[Tuple[str,str,str]] = []
+        self._runner.run()
 
-        for t in tag_str.splitlines():
-            r1 = subprocess.run(['notmuch', 'count', '--output=threads', '--', 'tag:'+t],
-                    stdout=subprocess.PIPE)
-            c = r1.stdout.decode('utf-8').strip()
-            r1 = subprocess.run(['notmuch', 'count', '--output=threads', '--', f'tag:{t} AND tag:unread'],
-                    stdout=subprocess.PIPE)
-            cu = r1.stdout.decode('utf-8').strip()
-            self.d.append((t, cu, c))
+    def _counted(self, t: TagCountThread) -> None:
+        if t.counts is not None:
+            self._set_counts(t.revision, t.counts)
 
-        self.endResetModel()
+    def _set_counts(self, revision: str, counts: TagCounts) -> None:
+        TagModel._cache = (revision, counts)
+        if counts is not self._counts:
+            self.beginResetModel()
+            self._counts = counts
+            self._tags, self._unread, self._total = counts
+            self._count_strs = [f'[{u}/{t}]' for u, t in zip(self._unread, self._total)]
+            self.endResetModel()
+        self.refreshed.emit()
 
     def num_tags(self) -> int:
         """The number of tags in the database"""
 
-        return len(self.d)
+        return len(self._tags)
 
     def tag(self, index: QModelIndex) -> Optional[str]:
         """Return the tag name at the given model index"""
 
         row = index.row()
-        if row >= 0 and row < len(self.d):
-            return self.d[row][0]
+        if row >= 0 and row < len(self._tags):
+            return self._tags[row]
         else:
             return None
 
     def data(self, index: QModelIndex, role: int=Qt.ItemDataRole.DisplayRole) -> Any:
         """Overrides `QAbstractItemModel.data` to populate a view with tags"""
 
+        if role not in util.model_data_roles:
+            return None
+
         row = index.row()
         col = index.column()
-        if row >= len(self.d) or index.column() > 1:
+        if row >= len(self._tags) or col > 1:
             return None
 
         if role == Qt.ItemDataRole.DisplayRole:
             if col == 1:
-                return f'[{self.d[row][1]}/{self.d[row][2]}]'
+                return self._count_strs[row]
             else:
-                return self.d[row][0]
+                return self._tags[row]
         elif role == Qt.ItemDataRole.FontRole:
-            font = QFont(settings.search_font, settings.search_font_size)
-            if self.d[row][1] != '0':
-                font.setBold(True)
-            return font
+            return self._font_bold if self._unread[row] != 0 else self._font
         elif role == Qt.ItemDataRole.ForegroundRole:
-            if self.d[row][1] != '0':
-                return QColor(settings.theme['fg_subject_unread'])
-            else:
-                return QColor(settings.theme['fg'])
+            return self._fg_unread if self._unread[row] != 0 else self._fg
 
     def headerData(self, section: int, orientation: Qt.Orientation, role: int=Qt.ItemDataRole.DisplayRole) -> Any:
         """Overrides `QAbstractItemModel.headerData` to populate a view with column names"""
@@ -123,8 +258,7 @@ class TagModel(QAbstractItemModel):
         This is essentially an alias for :func:`num_tags`, but it also returns 0 if an index is
         given to tell Qt not to add any child items."""
 
-        if not index or not index.isValid(): return self.num_tags()
-        else: return 0
+        return 0 if index.isValid() else len(self._tags)
 
     def parent(self, child: QModelIndex=None) -> Any:
         """Always return an invalid index, since there are no nested indices"""
@@ -145,25 +279,29 @@ class TagPanel(panel.Panel):
         self.tree.setModel(self.model)
         self.layout().addWidget(self.tree)
 
-        self.tree.resizeColumnToContents(0)
         # self.tree.setColumnWidth(1, 900)
         # self.tree.setColumnWidth(2, 900)
 
         self.tree.doubleClicked.connect(self.search_current_tag)
-        if self.tree.model().rowCount() > 0:
-            self.tree.setCurrentIndex(self.tree.model().index(0,0))
 
-    def refresh(self) -> None:
-        """Refresh the search listing and restore the selection, if possible."""
+        # the tags are loaded in the background, select the first one when they arrive
+        self._current_row = -1
+        self.model.refreshed.connect(self._restore_current)
 
-        current = self.tree.currentIndex()
-        self.model.refresh()
-        
-        if current.row() >= self.model.num_tags():
+    def _restore_current(self) -> None:
+        if self._current_row == -1:
+            self.tree.resizeColumnToContents(0)
+            self.first_tag()
+        elif self._current_row >= self.model.num_tags():
             self.last_tag()
         else:
-            self.tree.setCurrentIndex(current)
+            self.tree.setCurrentIndex(self.model.index(self._current_row, 0))
 
+    def refresh(self) -> None:
+        """Refresh the tag listing and restore the selection, if possible."""
+
+        self._current_row = self.tree.currentIndex().row()
+        self.model.refresh()
         super().refresh()
 
     def title(self) -> str:
@@ -17,6 +17,9 @@
 # along with Dodo. If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
+import string
+import functools
+from collections import ChainMap
 from PyQt6.QtGui import QPalette, QColor
 from PyQt6.QtWidgets import QApplication
 
@@ -264,21 +267,18 @@ gruvbox_light = {
 .. _Gruvbox: https://github.com/morhetz/gruvbox
 """
 
-gruvbox_light_hard = gruvbox_light.copy()
+gruvbox_light_hard = ChainMap({'bg': gruvbox_p['light0_hard']}, gruvbox_light)
 """Theme based on the `Gruvbox`_ palette (light background, hard contrast)
 
 .. _Gruvbox: https://github.com/morhetz/gruvbox
 """
 
-gruvbox_light_soft = gruvbox_light.copy()
+gruvbox_light_soft = ChainMap({'bg': gruvbox_p['light0_soft']}, gruvbox_light)
 """Theme based on the `Gruvbox`_ palette (light background, soft contrast)
 
 .. _Gruvbox: https://github.com/morhetz/gruvbox
 """
 
-gruvbox_light_hard['bg'] = gruvbox_p['light0_hard']
-gruvbox_light_soft['bg'] = gruvbox_p['light0_soft']
-
 gruvbox_dark = gruvbox_light.copy()
 """Theme based on the `Gruvbox`_ palette (dark background)
 
@@ -296,42 +296,90 @@ gruvbox_dark.update({
   'fg_subject': gruvbox_p['light3'],
 })
 
-gruvbox_dark_hard = gruvbox_dark.copy()
+gruvbox_dark_hard = ChainMap({'bg': gruvbox_p['dark0_hard']}, gruvbox_dark)
 """Theme based on the `Gruvbox`_ palette (dark background, hard contrast)
 
 .. _Gruvbox: https://github.com/morhetz/gruvbox
 """
 
-gruvbox_dark_soft = gruvbox_dark.copy()
+gruvbox_dark_soft = ChainMap({'bg': gruvbox_p['dark0_soft']}, gruvbox_dark)
 """Theme based on the `Gruvbox`_ palette (dark background, soft contrast)
 
 .. _Gruvbox: https://github.com/morhetz/gruvbox
 """
 
-gruvbox_dark_hard['bg'] = gruvbox_p['dark0_hard']
-gruvbox_dark_soft['bg'] = gruvbox_p['dark0_soft']
 
+# QColor objects for each color string that has been used, see qcolor()
+_qcolor_cache: dict[str, QColor] = {}
+
+def qcolor(color: str) -> QColor:
+    """Return a QColor for the given color string, only parsing each string once
+
+    The cache is keyed by the color string itself, rather than a name in the theme, so it
+    never needs to be cleared when the theme changes. The returned QColor is shared, so it
+    shouldn't be modified."""
+
+    c = _qcolor_cache.get(color)
+    if c is None:
+        # the themes use '#rrggbb' throughout, which can be converted without Qt's parser,
+        # anything else (e.g. named colors from user config) is left to QColor
+        if len(color) == 7 and color[0] == '#' and not color[1:].strip(string.hexdigits):
+            c = QColor.fromRgb(0xff000000 | int(color[1:], 16))
+        else:
+            c = QColor(color)
+        _qcolor_cache[color] = c
+    return c
+
+# the palette role that each theme color is used for, several roles share the same color
+_ROLE_MAP = (
+    (QPalette.ColorRole.Window, 'bg'),
+    (QPalette.ColorRole.WindowText, 'fg'),
+    (QPalette.ColorRole.Base, 'bg'),
+    (QPalette.ColorRole.AlternateBase, 'bg_alt'),
+    (QPalette.ColorRole.ToolTipBase, 'bg'),
+    (QPalette.ColorRole.ToolTipText, 'fg'),
+    (QPalette.ColorRole.Text, 'fg'),
+    (QPalette.ColorRole.Button, 'bg_button'),
+    (QPalette.ColorRole.ButtonText, 'fg_button'),
+    (QPalette.ColorRole.BrightText, 'fg_bright'),
+    (QPalette.ColorRole.Link, 'fg_link'),
+    (QPalette.ColorRole.Highlight, 'bg_highlight'),
+    (QPalette.ColorRole.HighlightedText, 'fg_highlight'),
+)
+
+@functools.lru_cache(maxsize=None)
+def _build_palette(colors: tuple[str, ...]) -> QPalette:
+    """Build a palette with the given colors for each role in _ROLE_MAP
+
+    This is cached, so each distinct set of colors is only built into a palette once."""
+
+    palette = QPalette()
+    for (role, _), color in zip(_ROLE_MAP, colors):
+        palette.setColor(role, qcolor(color))
+    return palette
+
+# the role colors of the palette currently set on the application
+_current_colors: tuple[str, ...] = ()
 
 def apply_theme(theme: dict) -> None:
     """"Apply the given theme to GUI components
 
-    This is called when :class:`~dodo.app.Dodo` is initialised."""
+    This is called when :class:`~dodo.app.Dodo` is initialised. A palette is only built the
+    first time a theme with a given set of colors is applied, and switching back to it later
+    reuses that palette. If the colors haven't changed since the last call, the palette isn't
+    set again."""
 
-    # Force the style to be the same on all OSs:
-    QApplication.setStyle("Fusion")
+    global _current_colors
+
+    # Force the style to be the same on all OSs, setting the style re-polishes every widget,
+    # so only do it if needed:
+    style = QApplication.style()
+    if not style or style.name().lower() != 'fusion':
+        QApplication.setStyle("Fusion")
     # Now use a palette to switch to theme colors:
-    palette = QPalette()
-    palette.setColor(QPalette.ColorRole.Window, QColor(theme['bg']))
-    palette.setColor(QPalette.ColorRole.WindowText, QColor(theme['fg']))
-    palette.setColor(QPalette.ColorRole.Base, QColor(theme['bg']))
-    palette.setColor(QPalette.ColorRole.AlternateBase, QColor(theme['bg_alt']))
-    palette.setColor(QPalette.ColorRole.ToolTipBase, QColor(theme['bg']))
-    palette.setColor(QPalette.ColorRole.ToolTipText, QColor(theme['fg']))
-    palette.setColor(QPalette.ColorRole.Text, QColor(theme['fg']))
-    palette.setColor(QPalette.ColorRole.Button, QColor(theme['bg_button']))
-    palette.setColor(QPalette.ColorRole.ButtonText, QColor(theme['fg_button']))
-    palette.setColor(QPalette.ColorRole.BrightText, QColor(theme['fg_bright']))
-    palette.setColor(QPalette.ColorRole.Link, QColor(theme['fg_link']))
-    palette.setColor(QPalette.ColorRole.Highlight, QColor(theme['bg_highlight']))
-    palette.setColor(QPalette.ColorRole.HighlightedText, QColor(theme['fg_highlight']))
-    QApplication.setPalette(palette)
+    colors = tuple(theme[key] for _, key in _ROLE_MAP)
+    if colors == _current_colors:
+        return
+
+    _current_colors = colors
+    QApplication.setPalette(_build_palette(colors))
@@ -29,13 +29,14 @@ from PyQt6.QtWebEngineWidgets import *
 import sys
 import traceback
 import subprocess
-import json
 import re
 import email
 import email.parser
 import email.utils
 import email.message
 import itertools
+import collections
+import operator
 import tempfile
 import logging
 
@@ -44,21 +45,34 @@ from . import settings
 from . import util
 from . import keymap
 from . import panel
+from . import themes
 
 logger = logging.getLogger(__name__)
 
 def flatten(collection: list) -> Generator:
-    for elt in collection:
-        if isinstance(elt, list):
-            yield from flatten(elt)
-        else:
+    # walk the nested lists with a stack of iterators, rather than recursively
+    stack = [iter(collection)]
+    while stack:
+        for elt in stack[-1]:
+            if isinstance(elt, list):
+                stack.append(iter(elt))
+                break
             yield elt
+        else:
+            stack.pop()
 
 def flat_thread(d: list) -> List[dict]:
     "Return the thread as a flattened list of messages, sorted by date."
 
-    thread = list(flatten(d))
-    thread.sort(key=lambda m: m['timestamp'])
+    thread = []
+    stack = [d]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, list):
+            stack.extend(reversed(x))
+        else:
+            thread.append(x)
+    thread.sort(key=operator.itemgetter('timestamp'))
     return thread
 
 def short_string(m: dict) -> str:
@@ -89,8 +103,9 @@ class MessagePage(QWebEnginePage):
             msg = {'headers':{'To': url.path(), 'Subject': query.queryItemValue('subject')}}
             self.app.open_compose(mode='mailto', msg=msg)
         else:
+            host = url.host().lower()
             if (not settings.html_confirm_open_links or
-                url.host() in settings.html_confirm_open_links_trusted_hosts or
+                host in settings._trusted_hosts or host.endswith(settings._trusted_host_suffixes) or
                 QMessageBox.question(None, 'Open link',
                     f'Open the following URL in browser?\n\n  {url.toString()}') == QMessageBox.StandardButton.Yes):
                 if settings.web_browser_command == '':
@@ -115,89 +130,147 @@ class MessagePage(QWebEnginePage):
                 return settings.html_block_remote_requests
 
 
-class MessageHandler(QWebEngineUrlSchemeHandler):
-    def __init__(self, parent: Optional[QObject]=None):
-        super().__init__(parent)
-        self.message_json: Optional[dict] = None
+# the message CSS, and the HTML before and after the text of a plain text message built from it
+_plain_wrapper: Optional[tuple[str, bytes, bytes]] = None
 
-    def requestStarted(self, request: QWebEngineUrlRequestJob) -> None:
-        mode = request.requestUrl().toString()[len('message:'):]
+def _plain_text_wrapper() -> tuple[bytes, bytes]:
+    """Return the encoded HTML to write before and after the text of a plain text message
 
-        if self.message_json:
-            buf = QBuffer(parent=self)
-            buf.open(QIODevice.OpenModeFlag.WriteOnly)
-            if mode == 'html':
-                html = util.body_html(self.message_json)
-                html = re.sub(r'(<meta(?!\s*(?:name|value)\s*=)[^>]*?charset\s*=[\s"\']*)([^\s"\'/>]*)',
-                              r'\1utf-8', html, flags=re.M)
-                if html: buf.write(html.encode('utf-8'))
-            else:
-                for filt in settings.message2html_filters:
-                    try:
-                        text = filt(self.message_json)
-                    except Exception:
-                        print(
-                            f"Error in message2html filter {filt.__name__}, ignoring:",
-                            file=sys.stderr
-                        )
-                        traceback.print_exc(file=sys.stderr)
-                        continue
-                    if text is not None:
-                        break
-                else:
-                    text = util.simple_escape(util.body_text(self.message_json))
-                    text = util.colorize_text(text)
-                    text = util.linkify(text)
+    This only depends on the message CSS, so it is only rebuilt when
+    :func:`~dodo.util.make_message_css` returns a new string."""
 
-                if text:
-                    buf.write(f"""
+    global _plain_wrapper
+    css = util.make_message_css()
+    if _plain_wrapper is None or _plain_wrapper[0] is not css:
+        prefix = f"""
                     <html>
                     <head>
                     <meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>
                     <style type="text/css">
-                    {util.make_message_css()}
+                    {css}
                     </style>
                     </head>
                     <body>
-                    <pre style="white-space: pre-wrap">{text}</pre>
+                    <pre style="white-space: pre-wrap">"""
+        suffix = """</pre>
                     </body>
-                    </html>""".encode('utf-8'))
+                    </html>"""
+        _plain_wrapper = (css, prefix.encode('utf-8'), suffix.encode('utf-8'))
+    return _plain_wrapper[1], _plain_wrapper[2]
+
+class MessageHandler(QWebEngineUrlSchemeHandler):
+    """Handles 'message:html' and 'message:plain' requests by rendering the current message
+
+    The rendered pages of the last few messages shown are kept, so switching back and forth
+    between messages doesn't run the message through the HTML and plain text filters again."""
+
+    cache_size = 16
+    """The number of rendered pages to keep, keyed by message id and mode"""
+
+    def __init__(self, parent: Optional[QObject]=None):
+        super().__init__(parent)
+        self.message_json: Optional[dict] = None
+        self._cache: collections.OrderedDict[tuple[str, str], bytes] = collections.OrderedDict()
+
+    def requestStarted(self, request: QWebEngineUrlRequestJob) -> None:
+        mode = request.requestUrl().toString()[len('message:'):]
+
+        if self.message_json:
+            key = (self.message_json['id'], mode)
+            page = self._cache.get(key)
+            if page is None:
+                page = self._cache[key] = self._render(mode)
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(key)
 
+            buf = QBuffer(parent=self)
+            buf.open(QIODevice.OpenModeFlag.WriteOnly)
+            buf.write(page)
             buf.close()
             request.reply('text/html;charset=utf-8'.encode('latin1'), buf)
         else:
             request.fail(QWebEngineUrlRequestJob.Error.UrlNotFound)
 
+    def _render(self, mode: str) -> bytes:
+        """Render the current message as an HTML page, encoded as utf-8"""
+
+        assert self.message_json is not None
+        if mode == 'html':
+            html = util.body_html(self.message_json)
+            html = _META_CHARSET_RE.sub(r'\1utf-8', html)
+            return html.encode('utf-8') if html else b''
+        else:
+            for filt in settings.message2html_filters:
+                try:
+                    text = filt(self.message_json)
+                except Exception:
+                    print(
+                        f"Error in message2html filter {filt.__name__}, ignoring:",
+                        file=sys.stderr
+                    )
+                    traceback.print_exc(file=sys.stderr)
+                    continue
+                if text is not None:
+                    break
+            else:
+                text = util.text2html(util.body_text(self.message_json))
+                text = util.linkify(text)
+
+            if text:
+                prefix, suffix = _plain_text_wrapper()
+                return prefix + text.encode('utf-8') + suffix
+            else:
+                return b''
+
 
 class EmbeddedImageHandler(QWebEngineUrlSchemeHandler):
     def __init__(self, parent: Optional[QObject]=None):
         super().__init__(parent)
         self.message: Optional[email.message.Message] = None
+        self.filename: Optional[str] = None
+        self.parts_by_cid: dict[str, email.message.Message] = {}
+        # the content type and decoded payload for each cid that has been requested
+        self._replies: dict[str, tuple[bytes, bytes]] = {}
 
     def set_message(self, filename: str) -> None:
+        """Parse the given message file and index its parts by Content-ID
+
+        The first part with a given Content-ID wins, as it would when searching the message
+        from the top. Nothing is done if this file is already the current message."""
+
+        if filename == self.filename:
+            return
+        self.filename = filename
+        self._replies = {}
         with open(filename, 'rb') as f:
             self.message = email.parser.BytesParser().parse(f)
+        self.parts_by_cid = {}
+        for part in self.message.walk():
+            cid = part["Content-id"]
+            # headers with undecodable bytes come back as Header objects, which never matched
+            if isinstance(cid, str):
+                self.parts_by_cid.setdefault(cid, part)
 
     def requestStarted(self, request: QWebEngineUrlRequestJob) -> None:
         cid = request.requestUrl().toString()[len('cid:'):]
 
-        content_type = None
-        if self.message:
-            for part in self.message.walk():
-                if "Content-id" in part and part["Content-id"] == f'<{cid}>':
-                    content_type = part.get_content_type()
-                    buf = QBuffer(parent=self)
-                    buf.open(QIODevice.OpenModeFlag.WriteOnly)
-                    buf.write(part.get_payload(decode=True))
-                    buf.close()
-                    request.reply(content_type.encode('latin1'), buf)
-                    break
-
-            # with open('/home/aleks/git/dodo/images/dodo-screen-inbox.png', 'rb') as f:
-            #     buf.write(f.read())
-            # buf.close()
+        reply = self._replies.get(cid)
+        if reply is None:
+            part = self.parts_by_cid.get(f'<{cid}>')
+            if part:
+                reply = self._replies[cid] = (part.get_content_type().encode('latin1'),
+                                              part.get_payload(decode=True))
 
-        if not content_type:
+        if reply:
+            content_type, payload = reply
+            buf = QBuffer(parent=self)
+            buf.open(QIODevice.OpenModeFlag.WriteOnly)
+            buf.write(payload)
+            buf.close()
+            request.reply(content_type, buf)
+        else:
             request.fail(QWebEngineUrlRequestJob.Error.UrlNotFound)
 
 class RemoteBlockingUrlRequestInterceptor(QWebEngineUrlRequestInterceptor):
@@ -205,32 +278,46 @@ class RemoteBlockingUrlRequestInterceptor(QWebEngineUrlRequestInterceptor):
         if info.requestUrl().scheme() not in app.LOCAL_PROTOCOLS:
             info.block(settings.html_block_remote_requests)
 
-RE_REGEX = re.compile(r'^R[Ee]: ')
+# any number of "Re: " prefixes at the start of a subject
+RE_REGEX = re.compile(r'^(?:R[Ee]: )+')
+
+# the charset declared by a <meta> tag, which is rewritten to utf-8 since the html is re-encoded
+_META_CHARSET_RE = re.compile(r'(<meta(?!\s*(?:name|value)\s*=)[^>]*?charset\s*=[\s"\']*)([^\s"\'/>]*)', re.M)
 class ThreadItem:
-    def __init__(self, raw_data, parent: ThreadItem|None):
+    def __init__(self, raw_data, parent: ThreadItem|None, row: int):
         self.msg = raw_data[0]
         self.parent = parent
-        self.children = [ThreadItem(elt, self) for elt in raw_data[1]]
+        # the position of this item among its parent's children, or in the list of roots
+        self.row = row
+
+        # a message's headers don't change, so the string shown for it is only computed once,
+        # before the children are created so they can compare against this subject
+        headers = self.msg.get('headers', {})
+        name, addr = email.utils.parseaddr(headers.get('From', '(message) <>'))
+        self.name = name or addr
+        self.subject = RE_REGEX.sub('', headers.get('Subject', ''))
+        if parent and self.subject != parent.subject:
+            self.label = f"{self.name} — {self.subject}"
+        else:
+            self.label = self.name
+
+        self.children = [ThreadItem(elt, self, i) for i, elt in enumerate(raw_data[1])]
 
     def thread_string(self):
-        from_hdr = self.msg.get('headers', {}).get('From', '(message) <>')
-        name, addr = email.utils.parseaddr(from_hdr)
-        if not name:
-            name = addr
-        if not self.parent:
-            return name
-
-        subject = self.msg.get('headers', {}).get('Subject', '')
-        while RE_REGEX.match(subject):
-            subject = RE_REGEX.sub('', subject)
-        prev_subject = self.parent.msg.get('headers', {}).get('Subject', '')
-        while RE_REGEX.match(prev_subject):
-            prev_subject = RE_REGEX.sub('', prev_subject)
-
-        if subject != prev_subject:
-            return f"{name} — {subject}"
-        else:
-            return name
+        return self.label
+
+def _same_shape(roots1: list[ThreadItem], roots2: list[ThreadItem]) -> bool:
+    "Return True if the two forests have the same messages (by id) at the same positions."
+    stack = [(roots1, roots2)]
+    while stack:
+        items1, items2 = stack.pop()
+        if len(items1) != len(items2):
+            return False
+        for item1, item2 in zip(items1, items2):
+            if item1.msg['id'] != item2.msg['id']:
+                return False
+            stack.append((item1.children, item2.children))
+    return True
 
 def make_thread_trees(raw_thread_data: list) -> list[ThreadItem]:
     "Return the set of roots for a given thread. If the thread is linear, then all messages are roots."
@@ -241,9 +328,32 @@ def make_thread_trees(raw_thread_data: list) -> list[ThreadItem]:
             forest = forest[0][1]
 
     if has_multiple_children(raw_thread_data):
-        return [ThreadItem(root, None) for root in raw_thread_data]
+        return [ThreadItem(root, None, i) for i, root in enumerate(raw_thread_data)]
     else:
-        return [ThreadItem([msg, []], None) for msg in flatten(raw_thread_data)]
+        return [ThreadItem([msg, []], None, i) for i, msg in enumerate(flatten(raw_thread_data))]
+
+class ThreadFetchThread(QThread):
+    """A QThread used for reading a thread from notmuch
+
+    Used by :func:`~dodo.thread.ThreadModel.refresh`, so the GUI isn't blocked while
+    "notmuch show" runs and its output is parsed. When the thread finishes, `matches` and
+    `data` hold the ids of the messages matching the query and the parsed thread, or None if
+    reading them failed."""
+
+    def __init__(self, model: ThreadModel, parent: Optional[QObject]=None) -> None:
+        super().__init__(parent)
+        self.model = model
+        self.matches: Optional[set[str]] = None
+        self.data: Optional[list] = None
+
+    def run(self) -> None:
+        try:
+            self.matches = self.model._fetch_matching_ids()
+            self.data = self.model._fetch_full_thread()
+        except (OSError, ValueError) as e:
+            logger.error("Reading thread %s failed: %s", self.model.thread_id, e)
+            self.matches = None
+            self.data = None
 
 class ThreadModel(QAbstractItemModel):
     """A model containing a thread, its messages, and some metadata
@@ -253,6 +363,7 @@ class ThreadModel(QAbstractItemModel):
     "notmuch show --format=json", it contains information about attachments (e.g. filename), but not attachments
     themselves.
 
+    :param a: the unique instance of the :class:`~dodo.app.Dodo` app class, used for tagging
     :param thread_id: the unique thread identifier used by notmuch
     """
 
@@ -260,14 +371,34 @@ class ThreadModel(QAbstractItemModel):
 
     messageChanged = pyqtSignal(QModelIndex)
 
-    def __init__(self, thread_id: str, search_query: str, mode: Literal['conversation','thread']) -> None:
+    def __init__(self, a: app.Dodo, thread_id: str, search_query: str, mode: Literal['conversation','thread']) -> None:
         super().__init__()
+        self.app = a
         self.thread_id = thread_id
         self.query = search_query
         self.matches = set()
         self.raw_data = []
         self.roots = []
+        # the item for each message id in the thread, see find()
+        self._items_by_id: dict[str, ThreadItem] = {}
         self._mode: Literal['conversation','thread'] = mode
+        self._fetcher = util.ThreadRunner(self, lambda parent: ThreadFetchThread(self, parent), self._fetched)
+        # computed by default_message(), cleared when the messages or matches change
+        self._default_index: Optional[QModelIndex] = None
+
+        # fonts returned by data(), indexed by (irrelevant, unread), where irrelevant messages
+        # (those not matching the search query) are italic and unread messages are bold
+        font = QFont(settings.search_font, settings.search_font_size)
+        self._fonts = {}
+        for irrelevant in (False, True):
+            for unread in (False, True):
+                f = QFont(font)
+                f.setItalic(irrelevant)
+                f.setBold(unread)
+                self._fonts[(irrelevant, unread)] = f
+        self._fg = themes.qcolor(settings.theme['fg'])
+        self._fg_unread = themes.qcolor(settings.theme['fg_subject_unread'])
+        self._fg_irrelevant = themes.qcolor(settings.theme['fg_subject_irrelevant'])
 
     @property
     def mode(self) -> Literal['conversation','thread']:
@@ -279,25 +410,22 @@ class ThreadModel(QAbstractItemModel):
             self._mode = 'thread'
         else:
             self._mode = 'conversation'
-        self.roots = self.compute_roots(self.raw_data)
+        self._set_roots(self.compute_roots(self.raw_data))
+        self._default_index = None
         self.endResetModel()
 
     def compute_roots(self, raw_data):
         match self.mode:
             case 'conversation':
-                return [ThreadItem([msg, []], None) for msg in flat_thread(raw_data)]
+                return [ThreadItem([msg, []], None, i) for i, msg in enumerate(flat_thread(raw_data))]
             case 'thread':
                 return make_thread_trees(raw_data)
 
     def _fetch_full_thread(self) -> list:
-        r = subprocess.run(['notmuch', 'show', '--exclude=false', '--format=json', '--verify', '--include-html', '--decrypt=true', self.thread_id],
-                stdout=subprocess.PIPE, encoding='utf8')
-        return json.loads(r.stdout)
+        return util.notmuch_json(['show', '--exclude=false', '--format=json', '--verify', '--include-html', '--decrypt=true', self.thread_id])
 
     def _fetch_matching_ids(self) -> set[str]:
-        r = subprocess.run(['notmuch', 'search', '--exclude=false', '--format=json', '--output=messages', f'thread:{self.thread_id} AND {self.query}'],
-                stdout=subprocess.PIPE, encoding='utf8')
-        return set(json.loads(r.stdout))
+        return set(util.notmuch_json(['search', '--exclude=false', '--format=json', '--output=messages', f'thread:{self.thread_id} AND {self.query}']))
 
     def get_last_msg_idx(self, parent: QModelIndex=QModelIndex()) -> QModelIndex:
         children = parent.internalPointer().children
@@ -306,27 +434,64 @@ class ThreadModel(QAbstractItemModel):
         return parent
 
     def refresh(self) -> None:
-        """Refresh the model by calling "notmuch show"."""
+        """Refresh the model by calling "notmuch show"
+
+        The notmuch calls are made by a :class:`ThreadFetchThread`, so this returns right
+        away and the model is updated once their output has been parsed. If a refresh is
+        already running, another one is started when it finishes."""
 
         logger.info("Full thread refresh")
-        matches = self._fetch_matching_ids()
-        data = self._fetch_full_thread()
+        self._fetcher.run()
+
+    def _fetched(self, t: ThreadFetchThread) -> None:
+        if t.data is not None and t.matches is not None:
+            self._update(t.matches, t.data)
+
+    def _update(self, matches: set[str], data: list) -> None:
+        """Update the model with the output of :func:`_fetch_matching_ids` and :func:`_fetch_full_thread`"""
+
         assert len(data) == 1, data
         data = data[0]
         roots = self.compute_roots(data)
-        self.beginResetModel()
-        self.raw_data = data
-        self.roots = roots
-        self.matches = matches
-        self.endResetModel()
+        if _same_shape(self.roots, roots):
+            # Same messages in the same places, so update them in-place to keep the existing
+            # indices (and the view's selection and expanded rows) valid
+            logger.info("Thread unchanged, updating messages in-place")
+            stack = list(zip(self.roots, roots))
+            while stack:
+                old, new = stack.pop()
+                old.msg.clear()
+                old.msg.update(new.msg)
+                stack.extend(zip(old.children, new.children))
+            self.matches = matches
+            self._default_index = None
+            self._emit_all_changed()
+        else:
+            self.beginResetModel()
+            self.raw_data = data
+            self._set_roots(roots)
+            self.matches = matches
+            self._default_index = None
+            self.endResetModel()
+
+    def _emit_all_changed(self) -> None:
+        """Emit dataChanged for every row, one signal per group of siblings"""
+
+        stack = [(QModelIndex(), self.roots)]
+        while stack:
+            parent, children = stack.pop()
+            if not children: continue
+            self.dataChanged.emit(self.index(0, 0, parent), self.index(len(children)-1, 0, parent))
+            for i, c in enumerate(children):
+                if c.children:
+                    stack.append((self.createIndex(i, 0, c), c.children))
 
     def refresh_message(self, msg_id: str):
         idx = self.find(msg_id)
         assert idx.isValid(), msg_id
         logger.info("Single message refresh: %s", msg_id)
-        r = subprocess.run(['notmuch', 'show', '--entire-thread=false', '--exclude=false', '--format=json', '--verify', '--include-html', '--decrypt=true', f'id:{msg_id}'],
-                stdout=subprocess.PIPE, encoding='utf8')
-        msg = next(m for m in flatten(json.loads(r.stdout)) if m is not None)
+        d = util.notmuch_json(['show', '--entire-thread=false', '--exclude=false', '--format=json', '--verify', '--include-html', '--decrypt=true', f'id:{msg_id}'])
+        msg = next(m for m in flatten(d) if m is not None)
         logger.info("refreshed tags: %s", str(msg['tags']))
         # We need to refresh the matches in case the message dropped out of the set
         matches = self._fetch_matching_ids()
@@ -335,7 +500,12 @@ class ThreadModel(QAbstractItemModel):
         old_msg.clear()
         old_msg.update(msg)
         self.matches = matches
+        self._default_index = None
         self.dataChanged.emit(idx, idx)
+        # a full refresh that is still running may have read the old tags, so run another
+        # one after it rather than letting it overwrite these
+        if self._fetcher.thread:
+            self._fetcher.run()
 
     def tag_message(self, idx: QModelIndex, tag_expr: str) -> None:
         """Apply the given tag expression to the current message
@@ -349,9 +519,19 @@ class ThreadModel(QAbstractItemModel):
         msg_id = m['id']
         if not ('+' in tag_expr or '-' in tag_expr):
             tag_expr = '+' + tag_expr
-        r = subprocess.run(['notmuch', 'tag'] + tag_expr.split() + ['--', 'id:' + msg_id],
-                stdout=subprocess.PIPE)
-        self.messageChanged.emit(idx)
+
+        def done() -> None:
+            # the model may have been refreshed in the meantime, so look the message up again
+            idx = self.find(msg_id)
+            if idx.isValid():
+                self.messageChanged.emit(idx)
+
+        self.app.tag(tag_expr, 'id:' + msg_id, done)
+
+        # Tagging happens in the background, so update the tags shown right away. These are
+        # replaced by the tags notmuch reports once the message is refreshed.
+        util.apply_tag_expr(m.setdefault('tags', []), tag_expr)
+        self.dataChanged.emit(idx, idx)
 
     def toggle_message_tag(self, idx: QModelIndex, tag: str) -> None:
         """Toggle the given tag on the current message"""
@@ -383,23 +563,43 @@ class ThreadModel(QAbstractItemModel):
 
     def iterate_indices(self) -> Iterable[QModelIndex]:
         """Iterate indices in the topological order"""
-        def rec_iterate_indices(node: QModelIndex) -> Iterable[QModelIndex]:
-            yield node
-            for i,c in enumerate(self._children_at(node)):
-                yield from rec_iterate_indices(self.createIndex(i, 0, c))
-        for i,r in enumerate(self.roots):
-            yield from rec_iterate_indices(self.createIndex(i, 0, r))
+        stack = list(reversed(list(enumerate(self.roots))))
+        while stack:
+            i, item = stack.pop()
+            yield self.createIndex(i, 0, item)
+            stack.extend(reversed(list(enumerate(item.children))))
 
     def find(self, msg_id: str) -> QModelIndex:
-        return next((idx for idx in self.iterate_indices() if self.message_at(idx)['id'] == msg_id), QModelIndex())
+        item = self._items_by_id.get(msg_id)
+        if item is None:
+            return QModelIndex()
+        return self.createIndex(item.row, 0, item)
+
+    def _set_roots(self, roots: list[ThreadItem]) -> None:
+        """Replace the items in the model and rebuild the index used by :func:`find`
+
+        Call between beginResetModel and endResetModel."""
+        self.roots = roots
+        self._items_by_id = {}
+        stack = list(reversed(roots))
+        while stack:
+            item = stack.pop()
+            self._items_by_id.setdefault(item.msg['id'], item)
+            stack.extend(reversed(item.children))
 
     def default_message(self) -> QModelIndex:
         """Return the index of either the oldest matching message or the last message
-        in the thread."""
-        for idx in self.iterate_indices():
-            if self.message_at(idx)['id'] in self.matches:
-                return idx
-        return self.get_last_msg_idx()
+        in the thread.
+
+        This is only searched for once after each change to the thread or its matches."""
+        if self._default_index is None:
+            for idx in self.iterate_indices():
+                if self.message_at(idx)['id'] in self.matches:
+                    self._default_index = idx
+                    break
+            else:
+                self._default_index = self.get_last_msg_idx()
+        return self._default_index
 
     def default_collapsed(self) -> set[str]:
         irrelevant_branches = set()
@@ -433,24 +633,54 @@ class ThreadModel(QAbstractItemModel):
         Currently, this just returns the message sender and makes it bold if the message is unread. Adding an
         emoji to show attachments would be good."""
 
+        if role not in util.model_data_roles:
+            return None
+
         item: ThreadItem = index.internalPointer()
-        m = item.msg
         if role == Qt.ItemDataRole.DisplayRole:
             return item.thread_string()
-        elif role == Qt.ItemDataRole.FontRole:
-            font = QFont(settings.search_font, settings.search_font_size)
-            if m['id'] not in self.matches:
-                font.setItalic(True)
-            if 'tags' in m and 'unread' in m['tags']:
-                font.setBold(True)
-            return font
-        elif role == Qt.ItemDataRole.ForegroundRole:
-            if m['id'] not in self.matches:
-                return QColor(settings.theme['fg_subject_irrelevant'])
-            if 'tags' in m and 'unread' in m['tags']:
-                return QColor(settings.theme['fg_subject_unread'])
+
+        irrelevant, unread = self._flags(item)
+        if role == Qt.ItemDataRole.FontRole:
+            return self._fonts[(irrelevant, unread)]
+        else:
+            return self._foreground(irrelevant, unread)
+
+    def multiData(self, index: QModelIndex, roleDataSpan: QModelRoleDataSpan) -> None:
+        """Overrides `QAbstractItemModel.multiData` to fill in all the roles a view asks for at once
+
+        Qt's item delegates request every role they use for a row in a single call, so this
+        looks up the message's flags once per row, rather than once per role."""
+
+        item: ThreadItem = index.internalPointer()
+        if item is None:
+            return
+
+        irrelevant, unread = self._flags(item)
+        for role_data in roleDataSpan:
+            role = role_data.role()
+            if role == Qt.ItemDataRole.DisplayRole:
+                role_data.setData(item.thread_string())
+            elif role == Qt.ItemDataRole.FontRole:
+                role_data.setData(self._fonts[(irrelevant, unread)])
+            elif role == Qt.ItemDataRole.ForegroundRole:
+                role_data.setData(self._foreground(irrelevant, unread))
             else:
-                return QColor(settings.theme['fg'])
+                role_data.clearData()
+
+    def _flags(self, item: ThreadItem) -> tuple[bool, bool]:
+        """Return a pair (irrelevant, unread) for the message in the given item"""
+
+        m = item.msg
+        return m['id'] not in self.matches, 'tags' in m and 'unread' in m['tags']
+
+    def _foreground(self, irrelevant: bool, unread: bool) -> QColor:
+        if irrelevant:
+            return self._fg_irrelevant
+        elif unread:
+            return self._fg_unread
+        else:
+            return self._fg
 
     def index(self, row: int, column: int, parent: QModelIndex=QModelIndex()) -> QModelIndex:
         """Construct a `QModelIndex` for the given row and (irrelevant) column"""
@@ -463,10 +693,7 @@ class ThreadModel(QAbstractItemModel):
         data = child.internalPointer()
         if data is None or data.parent is None:
             return QModelIndex()
-        aunties = data.parent.parent.children if data.parent.parent else self.roots
-        for i,c in enumerate(aunties):
-            if c == data.parent:
-                return self.createIndex(i, 0, data.parent)
+        return self.createIndex(data.parent.row, 0, data.parent)
 
     def columnCount(self, index: QModelIndex=QModelIndex()) -> int:
         """Constant = 1"""
@@ -477,6 +704,20 @@ class ThreadModel(QAbstractItemModel):
         return len(self._children_at(parent))
 
 
+def _header_css() -> str:
+    """Return the style sheet for the table of headers shown above each message
+
+    This is set once as the default style sheet of the header document, so the HTML built
+    for each message only needs to refer to its classes."""
+
+    theme = settings.theme
+    return f"""
+    table {{ background-color: {theme['bg']}; color: {theme['fg']}; font-family: {settings.search_font}; font-size: {settings.search_font_size}pt; }}
+    b {{ color: {theme['fg_bright']}; }}
+    .tags {{ color: {theme['fg_tags']}; font-family: {settings.tag_font}; font-size: {settings.tag_font_size}; }}
+    .attachments {{ color: {theme['fg_tags']}; }}
+    """
+
 class ThreadPanel(panel.Panel):
     """A panel showing an email thread
 
@@ -489,11 +730,15 @@ class ThreadPanel(panel.Panel):
     def __init__(self, a: app.Dodo, thread_id: str, search_query: str, parent: Optional[QWidget]=None):
         super().__init__(a, parent=parent)
         self.set_keymap(keymap.thread_keymap)
-        self.model = ThreadModel(thread_id, search_query, settings.default_thread_list_mode)
+        self.model = ThreadModel(a, thread_id, search_query, settings.default_thread_list_mode)
         self.thread_id = thread_id
         self.html_mode = settings.default_to_html
         self._saved_msg = None
         self._saved_collapsed = None
+        # the message id and html_mode of the page in the message view
+        self._shown: Optional[tuple[str, bool]] = None
+        # identifies the message shown in the header table, see refresh_view()
+        self._header_key: Optional[tuple] = None
 
         self.subject = '(no subject)'
 
@@ -503,14 +748,17 @@ class ThreadPanel(panel.Panel):
         self.thread_list.header().setStretchLastSection(False)
         self.thread_list.setHeaderHidden(True)
         self.thread_list.setRootIsDecorated(False)
+        # all rows use the same font family and size, so Qt doesn't need to measure each one
+        self.thread_list.setUniformRowHeights(True)
         self.thread_list.setModel(self.model)
         self.thread_list.clicked.connect(self._select_index)
         self.model.modelAboutToBeReset.connect(self._prepare_reset)
         self.model.modelReset.connect(self._do_reset)
-        self.model.dataChanged.connect(lambda _a,_b: self.refresh_view())
+        self.model.dataChanged.connect(self._data_changed)
         self.model.messageChanged.connect(lambda idx: self.app.update_single_thread(self.thread_id, msg_id=self.model.message_at(idx)['id']))
 
         self.message_info = QTextBrowser()
+        self.message_info.document().setDefaultStyleSheet(_header_css())
 
         # TODO: this leaks memory, but stops Qt from cleaning up the profile too soon
         self.message_profile = QWebEngineProfile(self.app)
@@ -570,6 +818,13 @@ class ThreadPanel(panel.Panel):
         else:
             self._select_index(self.model.default_message())
 
+    def _data_changed(self, top_left: QModelIndex, bottom_right: QModelIndex) -> None:
+        # only the current message is shown, so other rows changing doesn't need a refresh
+        current = self.current_index
+        if (current.isValid() and current.parent() == top_left.parent() and
+                top_left.row() <= current.row() <= bottom_right.row()):
+            self.refresh_view()
+
     def toggle_list_mode(self):
         self.model.toggle_mode()
 
@@ -577,9 +832,9 @@ class ThreadPanel(panel.Panel):
         if not index.isValid():
             return
         self.thread_list.setCurrentIndex(index)
-        # We only refresh the view if there was no tagging
-        if not self.model.mark_as_read(index):
-            self.refresh_view()
+        # tagging happens in the background, so show the message right away
+        self.model.mark_as_read(index)
+        self.refresh_view()
 
     def layout_panel(self):
         """Method for laying out various components in the ThreadPanel"""
@@ -624,6 +879,8 @@ class ThreadPanel(panel.Panel):
 
     def refresh_view(self):
         """Refresh the UI, without refreshing the underlying content"""
+        # the thread is read in the background, so there might not be a message to show yet
+        if not self.current_index.isValid(): return
         m = self.current_message
 
         if 'headers' in m and 'Subject' in m['headers']:
@@ -631,68 +888,65 @@ class ThreadPanel(panel.Panel):
         else:
             self.subject = '(no subject)'
 
-        if 'headers' in m:
-            header_html = ''
-            header_html += f'<table style="background-color: {settings.theme["bg"]}; color: {settings.theme["fg"]}; font-family: {settings.search_font}; font-size: {settings.search_font_size}pt; width:100%">'
-            for name in ['Subject', 'Date', 'From', 'To', 'Cc']:
-                if name in m['headers']:
-                    header_html += f"""<tr>
-                      <td><b style="color: {settings.theme["fg_bright"]}">{name}:&nbsp;</b></td>
-                      <td>{util.simple_escape(m["headers"][name])}</td>
-                    </tr>"""
+        # a message's headers and attachments never change, so the header table only needs
+        # rebuilding for a different message, or when its tags or crypto status change
+        header_key = (m['id'], tuple(m.get('tags', ())), m.get('crypto'))
+        if 'headers' in m and header_key != self._header_key:
+            self._header_key = header_key
+            # styles come from the document's default style sheet, see _header_css()
+            def row(name: str, value: str) -> str:
+                return f'<tr><td><b>{name}:&nbsp;</b></td><td>{value}</td></tr>'
+
+            parts = ['<table>']
+            headers = m['headers']
+            for name in ('Subject', 'Date', 'From', 'To', 'Cc'):
+                if name in headers:
+                    parts.append(row(name, util.simple_escape(headers[name])))
             if 'tags' in m:
-                tags = ' '.join([settings.tag_icons[t] if t in settings.tag_icons else f'[{t}]' for t in m['tags']])
-                header_html += f"""<tr>
-                  <td><b style="color: {settings.theme["fg_bright"]}">Tags:&nbsp;</b></td>
-                  <td><span style="color: {settings.theme["fg_tags"]}; font-family: {settings.tag_font}; font-size: {settings.tag_font_size}">{tags}</span></td>
-                </tr>"""
+                icon = settings.tag_icons.get
+                tags = ' '.join([icon(t, f'[{t}]') for t in m['tags']])
+                parts.append(row('Tags', f'<span class="tags">{tags}</span>'))
             attachments = [f'[{part["filename"]}]' for part in util.message_parts(m)
                     if part.get('content-disposition') == 'attachment' and 'filename' in part]
 
             if len(attachments) != 0:
-                header_html += f"""<tr>
-                  <td><b style="color: {settings.theme["fg_bright"]}">Attachments:&nbsp;</b></td>
-                  <td><span style="color: {settings.theme["fg_tags"]}">{' '.join(attachments)}</span></td>
-                </tr>"""
+                parts.append(row('Attachments', f'<span class="attachments">{" ".join(attachments)}</span>'))
 
             # Show pgp-Signature Status
             if 'signed' in m['crypto']:
                 for sig in m['crypto']['signed']['status']:
-                    header_html += f"""<tr>
-                      <td><b style="color: {settings.theme["fg_bright"]}">Pgp-signed:&nbsp;</b></td>
-                      <td>{sig['status']}: """
+                    status = f"{sig['status']}: "
                     if sig['status'] == 'error':
-                        header_html += f"{' '.join(sig['errors'].keys())} (keyid={sig['keyid']})"
+                        status += f"{' '.join(sig['errors'].keys())} (keyid={sig['keyid']})"
                     elif sig['status'] == 'good':
-                        header_html += f"{sig.get('userid')} ({sig['fingerprint']})"
+                        status += f"{sig.get('userid')} ({sig['fingerprint']})"
                     elif sig['status'] == 'bad':
-                        header_html += f"keyid={sig['keyid']}"
-                    header_html += "</td></tr>"
+                        status += f"keyid={sig['keyid']}"
+                    parts.append(row('Pgp-signed', status))
 
             # Show Decryption status
             if 'decrypted' in m['crypto']:
-                header_html += f"""<tr>
-                  <td><b style="color: {settings.theme["fg_bright"]}">Decryption:&nbsp;</b></td>
-                  <td>{m['crypto']['decrypted']['status']}"""
-                header_html += "</td></tr>"
+                parts.append(row('Decryption', m['crypto']['decrypted']['status']))
 
             # Show message id
-            header_html += f"""<tr>
-              <td><b style="color: {settings.theme["fg_bright"]}">Id:&nbsp;</b></td>
-              <td>{util.simple_escape(m["id"])}</td>
-            </tr>"""
-            header_html += '</table>'
-            self.message_info.setHtml(header_html)
+            parts.append(row('Id', util.simple_escape(m["id"])))
+            parts.append('</table>')
+            self.message_info.setHtml(''.join(parts))
 
         self.message_handler.message_json = m
 
-        if self.html_mode:
-            if 'filename' in m and len(m['filename']) != 0:
-                self.image_handler.set_message(m['filename'][0])
-            self.message_view.page().setUrl(QUrl('message:html'))
-        else:
-            self.message_view.page().setUrl(QUrl('message:plain'))
-        self.scroll_message(pos = 'top')
+        # reloading the page is expensive and scrolls back to the top, so only do it if a
+        # different message or mode is being shown
+        shown = (m['id'], self.html_mode)
+        if shown != self._shown:
+            self._shown = shown
+            if self.html_mode:
+                if 'filename' in m and len(m['filename']) != 0:
+                    self.image_handler.set_message(m['filename'][0])
+                self.message_view.page().setUrl(QUrl('message:html'))
+            else:
+                self.message_view.page().setUrl(QUrl('message:plain'))
+            self.scroll_message(pos = 'top')
         self.has_refreshed.emit()
 
 
@@ -749,6 +1003,7 @@ class ThreadPanel(panel.Panel):
         return self.model.message_at(self.current_index)
 
     def toggle_message_tag(self, tag: str) -> None:
+        if not self.current_index.isValid(): return
         return self.model.toggle_message_tag(self.current_index, tag)
 
     def tag_message(self, tag_expr: str) -> None:
@@ -769,6 +1024,7 @@ class ThreadPanel(panel.Panel):
         :param to_all: if True, do a reply to all instead (see `~dodo.compose.ComposePanel`)
         """
 
+        if not self.current_index.isValid(): return
         self.app.open_compose(mode='replyall' if to_all else 'reply',
                               msg=self.current_message)
 
@@ -776,6 +1032,7 @@ class ThreadPanel(panel.Panel):
         """Open a :class:`~dodo.compose.ComposePanel` populated with a forwarded message
         """
 
+        if not self.current_index.isValid(): return
         self.app.open_compose(mode='forward', msg=self.current_message)
 
     def open_attachments(self) -> None:
@@ -785,6 +1042,7 @@ class ThreadPanel(panel.Panel):
         do something smarter?
         """
 
+        if not self.current_index.isValid(): return
         m = self.current_message
         temp_dir, _ = util.write_attachments(m)
 
@@ -17,9 +17,9 @@
 # along with Dodo. If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
-from typing import Iterator, List, Tuple, Dict, Optional
+from typing import Iterator, List, Tuple, Dict, Optional, Any, Callable
 
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QObject, QThread
 from PyQt6.QtGui import QKeyEvent
 import re
 import os
@@ -31,11 +31,110 @@ import email.message
 import email.utils
 import email.policy
 import textwrap
+import json
 from bleach.sanitizer import Cleaner
 from bleach.linkifier import Linker
 
+# orjson is only needed for faster parsing of notmuch output, fall back on json when not present
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from . import settings
 
+json_loads = orjson.loads if orjson else json.loads
+"""Function used to parse JSON output from notmuch
+
+This is `orjson.loads` if orjson is installed, and `json.loads` otherwise. Both accept
+bytes, so the output of notmuch doesn't need to be decoded first.
+"""
+
+model_data_roles = frozenset({
+    Qt.ItemDataRole.DisplayRole,
+    Qt.ItemDataRole.FontRole,
+    Qt.ItemDataRole.ForegroundRole,
+})
+"""The roles Dodo's models return data for
+
+Qt asks for many other roles, which `data` can return None for straight away."""
+
+class ThreadRunner:
+    """Run a QThread in the background, at most one at a time
+
+    Used by models which refresh themselves from notmuch without blocking the GUI.
+
+    :param parent: the parent of each thread
+    :param make_thread: called with `parent` to create a new thread
+    :param done: called with the thread once it has finished
+    """
+
+    def __init__(self, parent: QObject, make_thread: Callable[[QObject], QThread],
+                 done: Callable[[Any], None]) -> None:
+        self.parent = parent
+        self.make_thread = make_thread
+        self.done = done
+        self.thread: Optional[QThread] = None
+        self.pending = False
+
+    def run(self) -> None:
+        """Start a new thread, or another one after the current thread if it is still running"""
+
+        if self.thread:
+            self.pending = True
+            return
+
+        t = self.make_thread(self.parent)
+
+        def finished() -> None:
+            self.thread = None
+            t.deleteLater()
+            self.done(t)
+            if self.pending:
+                self.pending = False
+                self.run()
+
+        self.thread = t
+        t.finished.connect(finished)
+        t.start()
+
+def notmuch_mail_root() -> str:
+    """Return the top-level directory of the Maildir indexed by notmuch
+
+    This is read from the notmuch config, using 'database.mail_root' if it is set
+    and 'database.path' otherwise."""
+
+    for key in ['database.mail_root', 'database.path']:
+        r = subprocess.run(['notmuch', 'config', 'get', key],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf8')
+        root = r.stdout.strip()
+        if root: return os.path.expanduser(root)
+    return ''
+
+def notmuch_revision() -> str:
+    """Return a string identifying the current state of the notmuch database
+
+    This contains the database UUID and its revision number, which notmuch increases on
+    every change, e.g. new messages or changed tags. It is read with "notmuch count --lastmod"
+    for a query that matches nothing, which is cheap even for large databases."""
+
+    r = subprocess.run(['notmuch', 'count', '--lastmod', '--', 'id:""'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf8')
+    return r.stdout.strip()
+
+def notmuch_json(args: List[str]) -> Any:
+    """Run notmuch with the given arguments and parse its JSON output
+
+    The output is read from the pipe as a single bytes object and handed straight to
+    :func:`json_loads`, without being decoded into a str first.
+
+    :param args: arguments to pass to notmuch, e.g. ['search', '--format=json', 'tag:inbox']
+    :returns: the parsed JSON output
+    """
+    with subprocess.Popen(['notmuch'] + args, stdout=subprocess.PIPE) as proc:
+        assert proc.stdout is not None
+        return json_loads(proc.stdout.read())
+
 def clean_html2html(s: str) -> str:
     """Sanitize the given HTML string
 
@@ -76,18 +175,19 @@ def w3m_html2text(s: str) -> str:
         return f"dodo w3m error: {e}"
     return p.stdout
 
+# using 2 instances of Linker() so explicit 'mailto:' links
+# get preference over email addresses. These build their HTML parser
+# and URL regexes when created, so they are made once and reused.
+_linker = Linker()
+_linker_email = Linker(parse_email=True)
+
 def linkify(s: str) -> str:
     """Link URLs and email addresses
 
     :param s: a plaintext input string
     :returns: HTML with URLs and emails linked
     """
-    lnk = Linker()
-    lnk_email = Linker(parse_email=True)
-
-    # using 2 instances of Linker() so explicit 'mailto:' links
-    # get preference over email addresses
-    return lnk_email.linkify(lnk.linkify(s))
+    return _linker_email.linkify(_linker.linkify(s))
 
 
 def get_header_addresses(
@@ -128,13 +228,16 @@ def decode_header(s: str) -> str:
 
     return str(email.header.make_header(email.header.decode_header(s)))
 
+_colorize_quoted_re = re.compile(r'^\s*&gt;')
+_colorize_empty_re = re.compile(r'^\s*$')
+
 def colorize_text(s: str, has_headers: bool=False) -> str:
     """Add some colors to HTML-escaped plaintext, for use inside <pre> tag
     """
 
     s1 = ""
-    quoted = re.compile(r'^\s*&gt;')
-    empty = re.compile(r'^\s*$')
+    quoted = _colorize_quoted_re
+    empty = _colorize_empty_re
 
     headers = has_headers
     for ln in s.splitlines():
@@ -158,6 +261,36 @@ def colorize_text(s: str, has_headers: bool=False) -> str:
 
 
 
+_text2html_re = re.compile(r'(?P<quoted>^[^\S\n]*>.*$)|[&<>]', re.M)
+_html_escapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+def _text2html_sub(m: re.Match) -> str:
+    if m.lastgroup == 'quoted':
+        return f'<span class="quoted">{simple_escape(m.group())}</span>'
+    return _html_escapes[m.group()]
+
+def text2html(s: str) -> str:
+    """Escape plaintext and color quoted lines, for use inside <pre> tag
+
+    This gives the same markup as :func:`simple_escape` followed by :func:`colorize_text`,
+    but makes a single pass over the text.
+    """
+
+    # split lines like colorize_text, which also breaks on e.g. lone '\r' and form feeds
+    lines = s.splitlines()
+    if not lines:
+        return ''
+    return _text2html_re.sub(_text2html_sub, '\n'.join(lines)) + '\n'
+
+def apply_tag_expr(tags: List[str], tag_expr: str) -> None:
+    """Apply a tag expression, e.g. "+flagged -unread", to a list of tags in place"""
+
+    for op in tag_expr.split():
+        if op[0] == '+' and op[1:] not in tags:
+            tags.append(op[1:])
+        elif op[0] == '-' and op[1:] in tags:
+            tags.remove(op[1:])
+
 def chop_s(s: str) -> str:
     if len(s) > 20:
         return s[0:20] + '...'
@@ -289,16 +422,9 @@ def email_is_me(e: str) -> bool:
     :class:`dodo.compose.Compose` to filter out the user's own email when forming
     a "reply-to-all" message.
     """
-    if isinstance(settings.email_address, dict):
-        addresses = [
-            strip_email_address(v) for v in settings.email_address.values()
-        ]
-    else:
-        addresses = [email.utils.parseaddr(settings.email_address)[1]]
-
     # nb: strip_email_address(e) is unnecessary with how this is used in compose.py,
     # but doing it avoids a future footgun, and it is idempotent.
-    return strip_email_address(e) in addresses
+    return strip_email_address(e) in settings._my_addresses
 
 def email_smtp_account_index(e: str) -> Optional[int]:
     """Index in settings.smtp_accounts of account having the provided email address
@@ -308,11 +434,7 @@ def email_smtp_account_index(e: str) -> Optional[int]:
     of first matching account or None if provided email does not match
     any smtp account.  """
     assert isinstance(settings.email_address, dict), settings.email_address
-    return next(
-            (i for i, acc in enumerate(settings.smtp_accounts) if
-             strip_email_address(e) ==
-             strip_email_address(settings.email_address[acc])
-             ), None)
+    return settings._account_by_address.get(strip_email_address(e))
 
 def separate_headers(s: str) -> Tuple[str, str]:
     """Split a message into its header part and body part"""
@@ -365,14 +487,30 @@ def replace_header(s: str, h: str, new_value: str) -> str:
     return headers + '\n' + body
 
 
+# the settings last used by make_message_css, and the CSS it produced
+_message_css_settings: Tuple[Any, ...] = ()
+_message_css = ''
+
 def make_message_css() -> str:
     """Fill placeholders in settings.message_css using the current theme
-    and font settings."""
-
-    d = settings.theme.copy()
-    d["message_font"] = settings.message_font
-    d["message_font_size"] = str(settings.message_font_size)
-    return settings.message_css.format(**d)
+    and font settings.
+
+    The result only changes when one of these settings is replaced, so the CSS is
+    formatted once and then reused for every message that is shown. The theme is
+    read-only once `config.py` has been loaded, so checking that the same theme
+    object is still in use is enough to tell that its colors haven't changed."""
+
+    global _message_css_settings, _message_css
+    current = (settings.message_css, settings.theme,
+               settings.message_font, settings.message_font_size)
+    if (len(current) != len(_message_css_settings) or
+            any(a is not b for a, b in zip(current, _message_css_settings))):
+        d = dict(settings.theme)
+        d["message_font"] = settings.message_font
+        d["message_font_size"] = str(settings.message_font_size)
+        _message_css = settings.message_css.format(**d)
+        _message_css_settings = current
+    return _message_css
 
 basic_keytab: Dict[int, str] = {
   Qt.Key.Key_0: '0',